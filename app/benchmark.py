@@ -0,0 +1,202 @@
+"""
+Benchmarks for the labelq hot paths.
+
+Usage:
+    python benchmark.py claims --num-records 100000 --num-claims 2000
+    python benchmark.py completion --num-tasks 10000
+    python benchmark.py records --num-records 100000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from sqlmodel import Session, SQLModel, create_engine
+
+from models import *
+
+
+def create_benchmark_engine(directory):
+    engine = create_engine(
+        f"sqlite:///{os.path.join(directory, 'benchmark.db')}",
+        connect_args={"check_same_thread": False},
+    )
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+def create_benchmark_labelqueue(engine, num_records: int, num_users: int = 1) -> int:
+    with Session(engine) as session:
+        dataset = Dataset(name="benchmark")
+        session.add(dataset)
+        session.flush()
+        session.execute(
+            insert(Record),
+            [dict(dataset_id=dataset.id, data={"i": i}) for i in range(num_records)],
+        )
+
+        labelqueue = LabelQueue(name="benchmark", dataset=dataset)
+        labelqueue.users = [
+            User(name=f"user {i}", email=f"user{i}@example.com", role=Role.labeler)
+            for i in range(num_users)
+        ]
+        session.add(labelqueue)
+        session.flush()
+        queuestep = QueueStep(
+            name="benchmark",
+            num_records=num_records,
+            type=QueueType.distribute,
+            labelqueue_id=labelqueue.id,
+            rank=1,
+            policy_args={},
+        )
+        session.add(queuestep)
+        session.flush()
+        queuestep.seed_frontier()
+        session.commit()
+
+        return labelqueue.id
+
+
+def time_claims(engine, labelqueue_id: int, num_claims: int) -> float:
+    """
+    Claim num_claims tasks one request at a time and return the mean latency in seconds.
+    """
+    start = time.perf_counter()
+    for _ in range(num_claims):
+        with Session(engine) as session:
+            labelqueue = session.get(LabelQueue, labelqueue_id)
+            labelqueue.create_task(labelqueue.users[0].id)
+            session.commit()
+
+    return (time.perf_counter() - start) / num_claims
+
+
+def benchmark_claims(num_records: int, num_claims: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_benchmark_engine(directory)
+        labelqueue_id = create_benchmark_labelqueue(engine, num_records)
+        latency = time_claims(engine, labelqueue_id, num_claims)
+
+    print(f"{latency * 1e6:.1f} us per claim")
+
+
+def benchmark_completion(num_tasks: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_benchmark_engine(directory)
+        labelqueue_id = create_benchmark_labelqueue(engine, num_tasks)
+
+        with Session(engine) as session:
+            labelqueue = session.get(LabelQueue, labelqueue_id)
+            tasks = labelqueue.create_tasks(labelqueue.users[0].id, num_tasks)
+            session.commit()
+            completions = [
+                TaskComplete(id=task.id, completed_data={"label": task.id % 7})
+                for task in tasks
+            ]
+
+        with Session(engine) as session:
+            start = time.perf_counter()
+            complete_tasks(session, completions)
+            session.commit()
+            elapsed = time.perf_counter() - start
+
+        print(f"completed {num_tasks} tasks in {elapsed * 1e3:.1f} ms")
+
+
+def insert_records_orm(session: Session, dataset: Dataset, payload: List[Dict]):
+    # the per-object path create_records used before the Core bulk insert
+    for record in [RecordCreate.parse_obj(it) for it in payload]:
+        db_record = Record.from_orm(record)
+        db_record.dataset_id = dataset.id
+        session.add(db_record)
+    session.flush()
+
+
+def benchmark_records(num_records: int):
+    payload = [{"data": {"i": i, "text": f"record {i}"}} for i in range(num_records)]
+    paths = [
+        ("orm", insert_records_orm),
+        (
+            "core, validated",
+            lambda session, dataset, payload: dataset.insert_records(
+                parse_records(payload)
+            ),
+        ),
+        (
+            "core, unvalidated",
+            lambda session, dataset, payload: dataset.insert_records(
+                [it["data"] for it in payload]
+            ),
+        ),
+    ]
+    for name, insert_records in paths:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_benchmark_engine(directory)
+            with Session(engine) as session:
+                dataset = Dataset(name="benchmark")
+                session.add(dataset)
+                session.commit()
+
+                start = time.perf_counter()
+                insert_records(session, dataset, payload)
+                session.commit()
+                elapsed = time.perf_counter() - start
+
+            print(
+                f"{name:>18}: {num_records / elapsed:10.0f} records/s "
+                f"({elapsed * 1e3:.1f} ms)"
+            )
+
+    # re-ingesting a payload that is 95% duplicates into a dataset with dedupe
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_benchmark_engine(directory)
+        with Session(engine) as session:
+            dataset = Dataset(name="benchmark", dedupe=True)
+            session.add(dataset)
+            session.commit()
+            num_new = num_records // 20
+            dataset.insert_records([it["data"] for it in payload[num_new:]])
+            session.commit()
+
+            start = time.perf_counter()
+            inserted = dataset.insert_records(parse_records(payload))
+            session.commit()
+            elapsed = time.perf_counter() - start
+
+        assert inserted.num_records == num_new
+        print(
+            f"{'dedupe re-ingest':>18}: {num_records / elapsed:10.0f} records/s "
+            f"({elapsed * 1e3:.1f} ms)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    claims_parser = subparsers.add_parser(
+        "claims", help="time task claims one request at a time"
+    )
+    claims_parser.add_argument("--num-records", type=int, default=100000)
+    claims_parser.add_argument("--num-claims", type=int, default=2000)
+
+    completion_parser = subparsers.add_parser(
+        "completion", help="time a bulk completion in one transaction"
+    )
+    completion_parser.add_argument("--num-tasks", type=int, default=10000)
+
+    records_parser = subparsers.add_parser(
+        "records", help="compare the ORM and Core record insert paths"
+    )
+    records_parser.add_argument("--num-records", type=int, default=100000)
+
+    args = parser.parse_args()
+    match args.benchmark:
+        case "claims":
+            benchmark_claims(args.num_records, args.num_claims)
+        case "completion":
+            benchmark_completion(args.num_tasks)
+        case "records":
+            benchmark_records(args.num_records)
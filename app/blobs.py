@@ -0,0 +1,114 @@
+from hashlib import blake2b
+from typing import Iterator
+import mmap
+import os
+import re
+import tempfile
+
+
+class BlobStore:
+    """
+    Content-addressed on-disk store for large record payload fields.
+
+    Blobs are named by the hex blake2b digest of their content and sharded into two levels of
+    directories by the digest prefix, e.g. root/ab/cd/abcd..., so that no directory grows too
+    large. Writes go to a temporary file that is renamed into place, so a blob is either
+    complete or absent, and storing the same content twice is a no-op. Reads memory-map the
+    blob instead of copying it through python file buffers.
+    """
+
+    digest_pattern = re.compile(r"^[0-9a-f]{64}$")
+
+    def __init__(self, root: str, min_size: int = 16384):
+        self.root = root
+        # string fields of at least min_size bytes are moved to the store
+        self.min_size = min_size
+
+    def path(self, digest: str) -> str:
+        if not isinstance(digest, str) or not self.digest_pattern.fullmatch(digest):
+            raise ValueError(f"{digest!r} is not a blob digest.")
+
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, content: bytes) -> str:
+        """
+        Store content and return its digest.
+        """
+        digest = blake2b(content, digest_size=32).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(content)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+        return digest
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b""
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                return content[:]
+
+    def iter_chunks(self, digest: str, chunk_size: int = 65536) -> Iterator[bytes]:
+        """
+        Read a blob in chunks, e.g. to stream it in a response.
+        """
+        with open(self.path(digest), "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                for start in range(0, len(content), chunk_size):
+                    yield content[start : start + chunk_size]
+
+    def offload(self, data):
+        """
+        Replace the large string fields of a record's data with {"$blob": digest} references.
+        """
+        if isinstance(data, dict):
+            return {key: self.offload(value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [self.offload(value) for value in data]
+        if isinstance(data, str) and len(data) >= self.min_size:
+            content = data.encode()
+            if len(content) >= self.min_size:
+                return {"$blob": self.put(content)}
+
+        return data
+
+    def resolve(self, data):
+        """
+        Replace the blob references in a record's data with their content.
+        """
+        if isinstance(data, dict):
+            if is_blob_reference(data):
+                return self.get(data["$blob"]).decode()
+            return {key: self.resolve(value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [self.resolve(value) for value in data]
+
+        return data
+
+
+def is_blob_reference(value) -> bool:
+    """
+    Whether a value is a {"$blob": digest} reference. Objects that only look like one, e.g.
+    user data with a "$blob" key that is not a digest, are left as plain data.
+    """
+    return (
+        isinstance(value, dict)
+        and len(value) == 1
+        and isinstance(value.get("$blob"), str)
+        and BlobStore.digest_pattern.fullmatch(value["$blob"]) is not None
+    )
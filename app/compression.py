@@ -0,0 +1,144 @@
+"""
+Compressed JSON columns, and an in-place migration of the JSON columns that predate them.
+The migration first brings the whole schema up to date with database.upgrade_db, the same
+upgrade that runs on startup.
+
+Usage:
+    python compression.py
+    python compression.py --chunk-size 10000 --no-vacuum
+"""
+
+from typing import Optional
+import argparse
+import json
+import zlib
+
+from sqlalchemy import LargeBinary, bindparam, select, text, update
+from sqlalchemy.types import TypeDecorator
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional, zlib is used without it
+    zstandard = None
+
+# payloads shorter than this are stored as plain JSON, compressing them does not pay off
+MIN_COMPRESSED_SIZE = 128
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# the first byte of a zlib stream with the default window; JSON text never starts with it
+ZLIB_MAGIC = b"\x78"
+
+
+def compress_json(value) -> bytes:
+    content = json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+    if len(content) < MIN_COMPRESSED_SIZE:
+        return content
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(content)
+    return zlib.compress(content, ZLIB_LEVEL)
+
+
+def decompress_json(content: bytes):
+    """
+    Decode a value written by compress_json, or plain JSON text written before compression.
+    The codec is told apart by the leading bytes, so zlib and zstd rows can be mixed.
+    """
+    if content.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Reading zstd compressed values requires zstandard.")
+        content = zstandard.ZstdDecompressor().decompress(content)
+    elif content.startswith(ZLIB_MAGIC):
+        content = zlib.decompress(content)
+
+    return json.loads(content)
+
+
+class CompressedJSON(TypeDecorator):
+    """
+    JSON stored as a compressed binary column. Values are compressed with zstd if zstandard
+    is installed, and with zlib otherwise.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect) -> Optional[bytes]:
+        if value is None:
+            return None
+        return compress_json(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            # a SQLite row written as JSON text before the migration
+            return json.loads(value)
+        return decompress_json(bytes(value))
+
+    def result_processor(self, dialect, coltype):
+        # the LargeBinary result processor rejects the text of unmigrated SQLite rows
+        return lambda value: self.process_result_value(value, dialect)
+
+
+def migrate_column(connection, table, column_name: str, chunk_size: int = 1000) -> int:
+    """
+    Rewrite a JSON column of a table in place as CompressedJSON, chunk_size rows per update
+    and commit. The schema must be up to date, so that the column is binary on PostgreSQL.
+    Rows that are already compressed are rewritten too, so rerunning the migration is safe
+    and moves zlib rows to zstd once zstandard is installed. Returns the number of rewritten
+    rows.
+    """
+    column = table.c[column_name]
+    num_rows = 0
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(table.c.id, column)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return num_rows
+        last_id = rows[-1][0]
+
+        connection.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values({column_name: bindparam("b_value")}),
+            [{"b_id": row_id, "b_value": value} for row_id, value in rows],
+        )
+        connection.commit()
+        num_rows += len(rows)
+
+
+if __name__ == "__main__":
+    from database import engine, upgrade_db
+    from models import Record, Task
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--no-vacuum",
+        dest="vacuum",
+        action="store_false",
+        help="skip the VACUUM that returns the freed pages of a SQLite database",
+    )
+    args = parser.parse_args()
+
+    upgrade_db(engine)
+    with engine.connect() as connection:
+        for table, column_name in [
+            (Record.__table__, "data"),
+            (Task.__table__, "completed_data"),
+        ]:
+            num_rows = migrate_column(connection, table, column_name, args.chunk_size)
+            print(f"compressed {table.name}.{column_name} in {num_rows} rows")
+
+    if args.vacuum and engine.dialect.name == "sqlite":
+        with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as connection:
+            connection.execute(text("VACUUM"))
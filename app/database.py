@@ -1,16 +1,198 @@
+from typing import List
 import os
 
+from sqlalchemy import (
+    LargeBinary,
+    MetaData,
+    UniqueConstraint,
+    distinct,
+    func,
+    inspect,
+    insert,
+    literal,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.schema import AddConstraint, CreateTable
 from sqlmodel import create_engine, SQLModel, Session
 
+from compression import CompressedJSON
+
 sqlite_url = os.environ["DATABASE_URI"]
-connect_args = {"check_same_thread": False}
+# concurrent task claims serialize on the SQLite write lock, so wait for it rather than fail
+connect_args = {"check_same_thread": False, "timeout": 30}
 engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
 
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(
-        engine,
+    upgrade_db(engine)
+
+
+def upgrade_db(engine):
+    """
+    Create missing tables and bring the tables of an existing database up to date with the
+    models: missing columns and indexes are added, unique constraints are replaced, JSON
+    columns that are now compressed become binary on PostgreSQL, and the counters of columns
+    and tables added since are backfilled from the tasks. Every step is a no-op on a database
+    that is already up to date, so this runs on every startup.
+    """
+    with engine.begin() as connection:
+        existing_tables = set(inspect(connection).get_table_names())
+        added_columns = set()
+        for table in SQLModel.metadata.sorted_tables:
+            if table.name in existing_tables:
+                added_columns.update(_add_missing_columns(connection, table))
+                _convert_compressed_columns(connection, table)
+                _replace_unique_constraints(connection, table)
+
+        SQLModel.metadata.create_all(connection)
+        for table in SQLModel.metadata.sorted_tables:
+            if table.name in existing_tables:
+                _create_missing_indexes(connection, table)
+
+        _backfill_counters(connection, existing_tables, added_columns)
+
+
+def _add_missing_columns(connection, table) -> List[str]:
+    existing = {
+        column["name"] for column in inspect(connection).get_columns(table.name)
+    }
+    added_columns = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+
+        # NOT NULL columns are added with their python default for the existing rows
+        definition = f"{column.name} {column.type.compile(dialect=connection.dialect)}"
+        if column.default is not None and column.default.is_scalar:
+            default = literal(column.default.arg, column.type).compile(
+                dialect=connection.dialect, compile_kwargs={"literal_binds": True}
+            )
+            definition += f" DEFAULT {default}"
+        if not column.nullable:
+            definition += " NOT NULL"
+        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+        added_columns.append(f"{table.name}.{column.name}")
+
+    return added_columns
+
+
+def _convert_compressed_columns(connection, table):
+    if connection.dialect.name != "postgresql":
+        # SQLite stores the compressed bytes in the JSON column as they are
+        return
+
+    types = {
+        column["name"]: column["type"]
+        for column in inspect(connection).get_columns(table.name)
+    }
+    for column in table.columns:
+        if isinstance(column.type, CompressedJSON) and not isinstance(
+            types[column.name], LargeBinary
+        ):
+            # the JSON text of existing rows stays readable as uncompressed values
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE bytea "
+                    f"USING convert_to({column.name}::text, 'UTF8')"
+                )
+            )
+
+
+def _replace_unique_constraints(connection, table):
+    expected = {
+        tuple(sorted(column.name for column in constraint.columns))
+        for constraint in table.constraints
+        if isinstance(constraint, UniqueConstraint)
+    }
+    existing = {
+        tuple(sorted(constraint["column_names"])): constraint["name"]
+        for constraint in inspect(connection).get_unique_constraints(table.name)
+    }
+    if set(existing) == expected:
+        return
+
+    if connection.dialect.name == "sqlite":
+        # SQLite cannot alter constraints, so the table is rebuilt; its indexes are created
+        # again by _create_missing_indexes
+        _rebuild_sqlite_table(connection, table)
+        return
+
+    for columns, name in existing.items():
+        if columns not in expected:
+            connection.execute(
+                text(f'ALTER TABLE {table.name} DROP CONSTRAINT "{name}"')
+            )
+    for constraint in table.constraints:
+        if (
+            isinstance(constraint, UniqueConstraint)
+            and tuple(sorted(column.name for column in constraint.columns))
+            not in existing
+        ):
+            connection.execute(AddConstraint(constraint))
+
+
+def _rebuild_sqlite_table(connection, table):
+    # the copy needs the tables its foreign keys refer to
+    metadata = MetaData()
+    for other in SQLModel.metadata.sorted_tables:
+        other.to_metadata(metadata)
+    rebuilt = table.to_metadata(metadata, name=f"_rebuilt_{table.name}")
+    columns = ", ".join(column.name for column in table.columns)
+
+    connection.execute(CreateTable(rebuilt))
+    connection.execute(
+        text(
+            f"INSERT INTO {rebuilt.name} ({columns}) SELECT {columns} FROM {table.name}"
+        )
     )
+    connection.execute(text(f"DROP TABLE {table.name}"))
+    connection.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {table.name}"))
+
+
+def _create_missing_indexes(connection, table):
+    existing = {index["name"] for index in inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(connection)
+
+
+def _backfill_counters(connection, existing_tables, added_columns):
+    tables = SQLModel.metadata.tables
+    queuestep, task = tables["queuestep"], tables["task"]
+    step_tasks = select(func.count(task.c.id)).where(
+        task.c.queuestep_id == queuestep.c.id
+    )
+
+    if "queuestep.num_records_assigned" in added_columns:
+        connection.execute(
+            update(queuestep).values(num_records_assigned=step_tasks.scalar_subquery())
+        )
+    if "queuestep.num_records_started" in added_columns:
+        connection.execute(
+            update(queuestep).values(
+                num_records_started=step_tasks.with_only_columns(
+                    func.count(distinct(task.c.record_id))
+                ).scalar_subquery()
+            )
+        )
+
+    user_stats = tables["queuestepuserstats"]
+    if user_stats.name not in existing_tables and task.name in existing_tables:
+        connection.execute(
+            insert(user_stats).from_select(
+                ["queuestep_id", "user_id", "num_assigned", "num_completed"],
+                select(
+                    task.c.queuestep_id,
+                    task.c.user_id,
+                    func.count(task.c.id),
+                    func.count(task.c.id).filter(task.c.completed == True),
+                )
+                .where(task.c.queuestep_id != None, task.c.user_id != None)
+                .group_by(task.c.queuestep_id, task.c.user_id),
+            )
+        )
 
 
 def get_session():
@@ -0,0 +1,145 @@
+"""
+Import records from NDJSON, CSV or Parquet files in bounded chunks.
+
+Usage:
+    python importer.py DATASET_ID records.parquet
+    python importer.py DATASET_ID records.csv --chunk-size 10000
+"""
+
+from itertools import islice
+from typing import Dict, Iterator, List, Tuple
+import argparse
+import csv
+import os
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
+
+from models import Dataset, RecordCreate, RecordFormat
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # parquet import is optional
+    pq = None
+
+
+def iter_record_chunks(
+    path: str, format: RecordFormat, chunk_size: int, skip: int = 0
+) -> Iterator[Tuple[int, List[Dict], List[Dict]]]:
+    """
+    Read the data payloads of the records in a file, chunk_size rows at a time. Yields the
+    number of rows read so far, the payloads of the chunk and the errors of its invalid rows.
+    The first skip rows are not read again, so that an interrupted import can resume.
+    NDJSON rows are lines; CSV rows exclude the header.
+    """
+    match format:
+        case RecordFormat.ndjson:
+            chunks = iter_ndjson_chunks(path, chunk_size, skip)
+        case RecordFormat.csv:
+            chunks = iter_csv_chunks(path, chunk_size, skip)
+        case RecordFormat.parquet:
+            chunks = iter_parquet_chunks(path, chunk_size, skip)
+        case _:
+            raise NotImplementedError(f"Cannot import {format.name} files.")
+
+    yield from chunks
+
+
+def iter_ndjson_chunks(path: str, chunk_size: int, skip: int):
+    records, errors = [], []
+    num_rows = skip
+    with open(path, "rb") as file:
+        for num_rows, line in enumerate(islice(file, skip, None), start=skip + 1):
+            if line.strip():
+                try:
+                    records.append(RecordCreate.parse_raw(line).data)
+                except ValidationError as e:
+                    errors.append(
+                        {"line": num_rows, "detail": jsonable_encoder(e.errors())}
+                    )
+
+            if len(records) + len(errors) == chunk_size:
+                yield num_rows, records, errors
+                records, errors = [], []
+
+    yield num_rows, records, errors
+
+
+def iter_csv_chunks(path: str, chunk_size: int, skip: int):
+    # every column of a row becomes a string field of the record's data; rows with more
+    # fields than the header would store the extra fields under a null key, so they are
+    # reported as errors instead
+    with open(path, newline="", encoding="utf-8") as file:
+        rows = islice(csv.DictReader(file), skip, None)
+        num_rows = skip
+        while chunk := list(islice(rows, chunk_size)):
+            records, errors = [], []
+            for num_rows, row in enumerate(chunk, start=num_rows + 1):
+                if None in row:
+                    errors.append(
+                        {
+                            "line": num_rows,
+                            "detail": "The row has more fields than the header.",
+                        }
+                    )
+                else:
+                    records.append(row)
+            yield num_rows, records, errors
+
+
+def iter_parquet_chunks(path: str, chunk_size: int, skip: int):
+    if pq is None:
+        raise RuntimeError("Importing parquet files requires pyarrow.")
+
+    # batches are read per row group, so memory is bounded by the chunk and row group size
+    num_rows = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        if num_rows + batch.num_rows > skip:
+            chunk = batch.slice(max(skip - num_rows, 0)).to_pylist()
+            yield num_rows + batch.num_rows, jsonable_encoder(chunk), []
+        num_rows += batch.num_rows
+
+
+def import_records(
+    session, dataset: Dataset, path: str, format: RecordFormat, chunk_size: int
+) -> int:
+    """
+    Import a file into the dataset, committing each chunk together with the frontier seeding.
+    Returns the number of records imported.
+    """
+    num_records = 0
+    for num_rows, records, errors in iter_record_chunks(path, format, chunk_size):
+        for error in errors:
+            print(f"skipped line {error['line']}: {error['detail']}")
+
+        inserted = dataset.ingest_records(records)
+        session.commit()
+
+        num_records += inserted.num_records
+        print(f"imported {num_records} records from {num_rows} rows")
+
+    return num_records
+
+
+if __name__ == "__main__":
+    from sqlmodel import Session
+
+    from database import engine
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("dataset_id", type=int)
+    parser.add_argument("path")
+    parser.add_argument(
+        "--format",
+        choices=[format.value for format in RecordFormat],
+        help="defaults to the file extension",
+    )
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    format = RecordFormat(args.format or os.path.splitext(args.path)[1].lstrip("."))
+    with Session(engine) as session:
+        dataset = session.get(Dataset, args.dataset_id)
+        if dataset is None:
+            parser.error(f"dataset {args.dataset_id} does not exist")
+        import_records(session, dataset, args.path, format, args.chunk_size)
@@ -1,22 +1,112 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    Depends,
+    Header,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import bindparam, delete, func, update
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
 from sqlmodel import Session, select
-from typing import List
-
-from database import create_db_and_tables, get_session
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import os
+import tempfile
+
+from blobs import BlobStore
+from database import create_db_and_tables, engine, get_session
+from importer import iter_record_chunks, pq
 from models import *
+from waiters import TaskWaiters
 
 app = FastAPI(swagger_ui_parameters={"tryItOutEnabled": "true"})
 
+# long-polling task requests wait here until their labelqueue may have work again
+task_waiters = TaskWaiters()
+
+# a task channel holds the labeler's current task and one prefetched task
+TASK_CHANNEL_SIZE = 2
+
+# number of records per insert and commit when records are ingested from a stream
+INGEST_CHUNK_SIZE = 1000
+
+# ingest jobs run in their own pool so that large uploads do not hold up request workers;
+# INGEST_WORKERS sets its size and INGEST_SPOOL_DIR where uploads are spooled
+ingest_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("INGEST_WORKERS", 2))
+)
+INGEST_SPOOL_DIR = os.environ.get("INGEST_SPOOL_DIR", tempfile.gettempdir())
+
+# BLOB_STORE_DIR moves string fields of at least BLOB_MIN_SIZE bytes out of the record rows
+if os.environ.get("BLOB_STORE_DIR"):
+    Record.blob_store = BlobStore(
+        os.environ["BLOB_STORE_DIR"],
+        min_size=int(os.environ.get("BLOB_MIN_SIZE", 16384)),
+    )
+
 
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
 
+    # queue steps created before the frontier existed are seeded once here; this is a no-op
+    # for steps whose frontier is already up to date
+    with Session(engine) as session:
+        for queuestep in session.exec(select(QueueStep)).all():
+            queuestep.seed_frontier()
+        session.commit()
+
+    resume_ingest_jobs(engine)
+
+
+def sweep_expired_tasks():
+    with Session(engine) as session:
+        num_released = release_expired_tasks(session)
+
+    if num_released:
+        task_waiters.notify_all()
+
+    return num_released
+
+
+@app.on_event("startup")
+async def start_lease_sweeper():
+    """
+    Periodically return tasks with expired leases to their queue and resume ingest jobs that
+    were abandoned by their worker. LEASE_SWEEP_INTERVAL sets the period in seconds.
+    """
+    interval = float(os.environ.get("LEASE_SWEEP_INTERVAL", 30))
+
+    async def sweep():
+        while True:
+            await asyncio.sleep(interval)
+            await run_in_threadpool(sweep_expired_tasks)
+            await run_in_threadpool(resume_ingest_jobs, engine)
+
+    app.state.lease_sweeper = asyncio.create_task(sweep())
+
+
+@app.on_event("shutdown")
+async def stop_lease_sweeper():
+    app.state.lease_sweeper.cancel()
+
+
+@app.on_event("shutdown")
+def stop_ingest_jobs():
+    ingest_executor.shutdown(wait=False, cancel_futures=True)
+
 
 # TODO: get specific task
 # TODO: get user tasks
-# TODO: implement consensus policy
 
 
 #
@@ -47,6 +137,25 @@ def get_dataset(*, session: Session = Depends(get_session), dataset_id):
     return dataset
 
 
+def ingest_records(session: Session, dataset: Dataset, records: List[Dict]) -> Dict:
+    """
+    Insert records with the Core bulk path, make them available to every labelqueue that
+    uses the dataset and commit. Returns the number of inserted records, their id range and
+    the number of duplicates that were skipped.
+    """
+    inserted = dataset.ingest_records(records)
+    session.commit()
+
+    for labelqueue in dataset.labelqueues:
+        task_waiters.notify(labelqueue.id)
+
+    return {
+        "ok": True,
+        **inserted.dict(),
+        "num_duplicates": len(records) - inserted.num_records,
+    }
+
+
 @app.post("/dataset/{dataset_id}/records/", tags=["Dataset"])
 def create_records(
     *, session: Session = Depends(get_session), dataset_id, records: List[RecordCreate]
@@ -55,15 +164,244 @@ def create_records(
     if not dataset:
         raise HTTPException(status_code=404, detail="Dataset not found")
 
-    db_records = []
-    for record in records:
-        it = Record.from_orm(record)
-        it.dataset_id = dataset_id
-        db_records.append(it)
-    session.add_all(db_records)
-    session.commit()
+    return ingest_records(session, dataset, [record.data for record in records])
 
-    return {"ok": True}
+
+@app.post("/dataset/{dataset_id}/records/bulk", tags=["Dataset"])
+async def create_records_bulk(
+    *,
+    session: Session = Depends(get_session),
+    request: Request,
+    dataset_id: int,
+    validate: bool = True,
+):
+    """
+    Bulk variant of create_records for large in-memory uploads. The body is the same list of
+    RecordCreate objects, but it is checked with plain type checks rather than a pydantic
+    model per record, or not at all with validate=false for trusted callers.
+    """
+    dataset = await run_in_threadpool(session.get, Dataset, dataset_id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail="Dataset not found")
+
+    body = await request.body()
+    try:
+        # decoding a large body takes a while, so it runs off the event loop
+        records = await run_in_threadpool(decode_records, body, validate)
+    except (ValueError, AttributeError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid records: {e}")
+
+    return await run_in_threadpool(ingest_records, session, dataset, records)
+
+
+def decode_records(body: bytes, validate: bool = True) -> List[Dict]:
+    """
+    Data payloads of a JSON list of RecordCreate objects, checked with parse_records unless
+    validate is false.
+    """
+    records = json.loads(body)
+    if validate:
+        return parse_records(records)
+
+    return [record.get("data", {}) for record in records]
+
+
+async def iter_lines(stream):
+    """
+    Split a byte stream into lines without holding more than one partial line in memory.
+    """
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    yield buffer
+
+
+@app.post("/dataset/{dataset_id}/records/ndjson", tags=["Dataset"])
+async def stream_records(
+    *, session: Session = Depends(get_session), request: Request, dataset_id: int
+):
+    """
+    Ingest records from an NDJSON body with one RecordCreate object per line.
+    The body is parsed as it arrives and inserted in chunks of INGEST_CHUNK_SIZE records,
+    each committed on its own, so memory use does not grow with the upload. If a line is
+    invalid, the chunks before it stay ingested and the response reports how many.
+    """
+    dataset = await run_in_threadpool(session.get, Dataset, dataset_id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail="Dataset not found")
+
+    num_records = 0
+    records = []
+    line_number = 0
+    async for line in iter_lines(request.stream()):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            records.append(RecordCreate.parse_raw(line).data)
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid record on line {line_number}: {e.errors()}. "
+                f"{num_records} records were ingested.",
+            )
+
+        if len(records) == INGEST_CHUNK_SIZE:
+            result = await run_in_threadpool(ingest_records, session, dataset, records)
+            num_records += result["num_records"]
+            records = []
+
+    if records:
+        result = await run_in_threadpool(ingest_records, session, dataset, records)
+        num_records += result["num_records"]
+
+    return {"ok": True, "num_records": num_records}
+
+
+# ids of the ingest jobs submitted to ingest_executor that have not finished yet
+submitted_ingest_jobs = set()
+
+
+def submit_ingest_job(bind, job_id: int):
+    """
+    Run an ingest job in ingest_executor, unless it is already waiting or running there.
+    """
+    if job_id in submitted_ingest_jobs:
+        return
+
+    def run():
+        try:
+            run_ingest_job(bind, job_id)
+        finally:
+            submitted_ingest_jobs.discard(job_id)
+
+    submitted_ingest_jobs.add(job_id)
+    ingest_executor.submit(run)
+
+
+def resume_ingest_jobs(bind, now: datetime = None) -> List[int]:
+    """
+    Submit the pending ingest jobs and the running jobs whose worker stopped sending
+    heartbeats, e.g. because it was restarted. They resume after their last ingested chunk;
+    jobs that another worker claims first are skipped by the claim in run_ingest_job.
+    Returns the ids of the jobs.
+    """
+    with Session(bind) as session:
+        job_ids = session.exec(
+            select(IngestJob.id).where(ingest_job_claimable(now or datetime.utcnow()))
+        ).all()
+
+    for job_id in job_ids:
+        submit_ingest_job(bind, job_id)
+
+    return job_ids
+
+
+def run_ingest_job(bind, job_id: int):
+    """
+    Ingest a spooled upload in chunks of INGEST_CHUNK_SIZE records. The job's progress is
+    committed with each chunk; invalid lines are counted and skipped. Jobs that another
+    worker is already running are left alone.
+    """
+    with Session(bind) as session:
+        if not claim_ingest_job(session, job_id):
+            return
+
+        job = session.get(IngestJob, job_id)
+        job.started_at = job.started_at or datetime.utcnow()
+        session.commit()
+
+        try:
+            dataset = session.get(Dataset, job.dataset_id)
+            # rows up to num_lines were ingested before the job was interrupted
+            for num_lines, records, errors in iter_record_chunks(
+                job.path, job.format, INGEST_CHUNK_SIZE, skip=job.num_lines
+            ):
+                inserted = dataset.ingest_records(records)
+                job.num_lines = num_lines
+                job.num_records += inserted.num_records
+                job.num_duplicates += len(records) - inserted.num_records
+                job.num_errors += len(errors)
+                if errors and len(job.errors) < MAX_INGEST_ERRORS:
+                    job.errors = (job.errors + errors)[:MAX_INGEST_ERRORS]
+                job.heartbeat_at = datetime.utcnow()
+                session.commit()
+
+                for labelqueue in dataset.labelqueues:
+                    task_waiters.notify(labelqueue.id)
+            job.status = IngestStatus.completed
+        except Exception as e:
+            session.rollback()
+            job.status = IngestStatus.failed
+            job.errors = job.errors + [{"detail": repr(e)}]
+
+        job.finished_at = datetime.utcnow()
+        session.commit()
+        if os.path.exists(job.path):
+            os.remove(job.path)
+
+
+def read_ingest_job(job: IngestJob) -> IngestJobRead:
+    return IngestJobRead(**job.dict(), records_per_second=job.get_records_per_second())
+
+
+@app.post(
+    "/dataset/{dataset_id}/records/jobs", response_model=IngestJobRead, tags=["Dataset"]
+)
+async def create_ingest_job(
+    *,
+    session: Session = Depends(get_session),
+    request: Request,
+    dataset_id: int,
+    format: RecordFormat = RecordFormat.ndjson,
+):
+    """
+    Ingest a large upload in the background. The body is an NDJSON file of RecordCreate
+    objects, or a CSV or Parquet file whose columns become the fields of each record's data.
+    The body is spooled to disk and the job is returned right away; its progress is reported
+    by GET /ingestjobs/{job_id}.
+    """
+    dataset = await run_in_threadpool(session.get, Dataset, dataset_id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail="Dataset not found")
+
+    if format == RecordFormat.parquet and pq is None:
+        raise HTTPException(
+            status_code=406, detail="Importing parquet files requires pyarrow."
+        )
+
+    fd, path = tempfile.mkstemp(suffix=f".{format.value}", dir=INGEST_SPOOL_DIR)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            async for chunk in request.stream():
+                await run_in_threadpool(file.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    def create_job():
+        job = IngestJob(dataset_id=dataset_id, format=format, path=path)
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        return job
+
+    job = await run_in_threadpool(create_job)
+    submit_ingest_job(session.get_bind(), job.id)
+
+    return read_ingest_job(job)
+
+
+@app.get("/ingestjobs/{job_id}", response_model=IngestJobRead, tags=["Dataset"])
+def get_ingest_job(*, session: Session = Depends(get_session), job_id: int):
+    job = session.get(IngestJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Ingest job not found")
+
+    return read_ingest_job(job)
 
 
 @app.patch(
@@ -76,10 +414,13 @@ def update_dataset(
     if not dataset:
         raise HTTPException(status_code=404, detail="Dataset not found")
 
+    dedupe = db_dataset.dedupe
     dataset_dict = dataset.dict(exclude_unset=True)
     for k, v in dataset_dict.items():
         setattr(db_dataset, k, v)
     session.add(db_dataset)
+    if db_dataset.dedupe and not dedupe:
+        db_dataset.backfill_content_hashes()
     session.commit()
     session.refresh(db_dataset)
     return db_dataset
@@ -91,6 +432,8 @@ def delete_dataset(*, session: Session = Depends(get_session), dataset_id: int):
     dataset = session.get(Dataset, dataset_id)
     if not dataset:
         raise HTTPException(status_code=404, detail="Dataset not found")
+    for labelqueue in dataset.labelqueues:
+        labelqueue.clear_frontier()
     session.delete(dataset)
     session.commit()
     return {"ok": True}
@@ -125,6 +468,8 @@ def register_dataset(
 
     labelqueue.dataset = dataset
     session.add(labelqueue)
+    session.flush()
+    labelqueue.seed_frontier()
     session.commit()
     session.refresh(labelqueue)
 
@@ -159,6 +504,7 @@ def unregister_dataset(
             detail=f"Tried to unregister dataset with ID={dataset_id} but labelqueue with ID={labelqueue_id} has dataset ID={labelqueue.dataset.id}",
         )
 
+    labelqueue.clear_frontier()
     labelqueue.dataset = None
     session.add(labelqueue)
     session.commit()
@@ -171,10 +517,22 @@ def unregister_dataset(
 # Records
 #
 @app.get("/records/{record_id}", response_model=RecordReadWithDataset, tags=["Record"])
-def get_record(*, session: Session = Depends(get_session), record_id):
+def get_record(
+    *, session: Session = Depends(get_session), record_id, resolve_blobs: bool = False
+):
+    """
+    Large fields of the record's data are {"$blob": digest} references that can be streamed
+    from /blobs/{digest}; with resolve_blobs they are inlined instead.
+    """
     record = session.get(Record, record_id)
     if not record:
         raise HTTPException(status_code=404, detail="Record not found")
+    if resolve_blobs and Record.blob_store is not None:
+        try:
+            data = Record.blob_store.resolve(record.data)
+        except FileNotFoundError:
+            raise HTTPException(status_code=500, detail="Record blob is missing")
+        return RecordReadWithDataset.from_orm(record).copy(update={"data": data})
     return record
 
 
@@ -185,23 +543,53 @@ def update_record(
     *, session: Session = Depends(get_session), record_id: int, record: RecordUpdate
 ):
     db_record = session.get(Record, record_id)
-    if not record:
+    if not db_record:
         raise HTTPException(status_code=404, detail="Record not found")
 
     record_dict = record.dict(exclude_unset=True)
+    if record_dict.get("data") is not None:
+        if Record.blob_store is not None:
+            record_dict["data"] = Record.blob_store.offload(record_dict["data"])
+        if db_record.dataset.dedupe:
+            # hashed after the offload, like the records inserted into the dataset
+            record_dict["content_hash"] = content_hash(record_dict["data"])
     for k, v in record_dict.items():
         setattr(db_record, k, v)
     session.add(db_record)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(
+            status_code=406,
+            detail="The data duplicates another record in the dataset.",
+        )
     session.refresh(db_record)
     return db_record
 
 
+@app.get("/blobs/{digest}", tags=["Record"])
+def get_blob(digest: str):
+    if Record.blob_store is None:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    try:
+        path = Record.blob_store.path(digest)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Blob not found")
+
+    return StreamingResponse(
+        Record.blob_store.iter_chunks(digest), media_type="text/plain; charset=utf-8"
+    )
+
+
 @app.delete("/records/{record_id}", tags=["Record"])
 def delete_record(*, session: Session = Depends(get_session), record_id: int):
     record = session.get(Record, record_id)
     if not record:
         raise HTTPException(status_code=404, detail="Record not found")
+    session.execute(delete(FrontierRecord).where(FrontierRecord.record_id == record_id))
     session.delete(record)
     session.commit()
     return {"ok": True}
@@ -236,6 +624,38 @@ def get_user(*, session: Session = Depends(get_session), user_id):
     return user
 
 
+@app.post("/users/{user_id}/task/", response_model=TaskReadWithRelations, tags=["User"])
+def create_user_task(*, session: Session = Depends(get_session), user_id: int):
+    """
+    Assign the next task from any of the user's labelqueues. A user with an incomplete task
+    gets that task back; otherwise the task is claimed from the labelqueue whose active queue
+    step has the most unassigned capacity, falling back to the next labelqueue if its
+    frontier turns out to be empty.
+    """
+    user = session.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    task = user.get_outstanding_task()
+    if task is not None:
+        task.labelqueue.activate_task(task)
+    else:
+        for queuestep in user.get_active_queuesteps():
+            task = queuestep.labelqueue.create_task(user_id, queuestep)
+            if task is not None:
+                break
+        else:
+            raise HTTPException(
+                status_code=406,
+                detail="None of the user's labelqueues has a task available.",
+            )
+
+    session.commit()
+    session.refresh(task)
+
+    return TaskReadWithRelations.from_orm(task)
+
+
 @app.patch("/users/{user_id}", response_model=UserReadWithLabelQueues, tags=["User"])
 def update_user(
     *, session: Session = Depends(get_session), user_id: int, user: UserUpdate
@@ -278,6 +698,90 @@ def get_queuestep(*, session: Session = Depends(get_session), queuestep_id):
     return queuestep
 
 
+@app.get(
+    "/queuesteps/{queuestep_id}/frontier",
+    response_model=List[int],
+    tags=["QueueStep"],
+)
+def get_queuestep_frontier(
+    *, session: Session = Depends(get_session), queuestep_id: int, limit: int = 100
+):
+    """
+    List the ids of the next records the queuestep will assign, in assignment order.
+    """
+    queuestep = session.get(QueueStep, queuestep_id)
+    if not queuestep:
+        raise HTTPException(status_code=404, detail="QueueStep not found")
+
+    return session.exec(
+        select(FrontierRecord.record_id)
+        .where(FrontierRecord.queuestep_id == queuestep_id)
+        .order_by(*FRONTIER_ORDER)
+        .limit(limit)
+    ).all()
+
+
+@app.get(
+    "/queuesteps/{queuestep_id}/users",
+    response_model=List[QueueStepUserStats],
+    tags=["QueueStep"],
+)
+def get_queuestep_user_stats(
+    *, session: Session = Depends(get_session), queuestep_id: int
+):
+    """
+    List the number of tasks each user was assigned and completed in the queuestep.
+    """
+    queuestep = session.get(QueueStep, queuestep_id)
+    if not queuestep:
+        raise HTTPException(status_code=404, detail="QueueStep not found")
+
+    return session.exec(
+        select(QueueStepUserStats)
+        .where(QueueStepUserStats.queuestep_id == queuestep_id)
+        .order_by(QueueStepUserStats.user_id)
+    ).all()
+
+
+@app.put("/queuesteps/{queuestep_id}/priorities", tags=["QueueStep"])
+def update_queuestep_priorities(
+    *,
+    session: Session = Depends(get_session),
+    queuestep_id: int,
+    priorities: List[RecordPriority],
+):
+    """
+    Set the priority of many frontier records of a priority queuestep in one set-based update,
+    e.g. to apply the scores of an active learning model. Records that have already been
+    assigned are skipped. A released record is re-seeded with the priority from its data.
+    """
+    queuestep = session.get(QueueStep, queuestep_id)
+    if not queuestep:
+        raise HTTPException(status_code=404, detail="QueueStep not found")
+
+    if queuestep.type != QueueType.priority:
+        raise HTTPException(
+            status_code=406,
+            detail="Priorities can only be set on a priority queue step.",
+        )
+
+    if not priorities:
+        return {"ok": True, "num_updated": 0}
+
+    updated = session.execute(
+        update(FrontierRecord)
+        .where(
+            FrontierRecord.queuestep_id == queuestep_id,
+            FrontierRecord.record_id == bindparam("b_record_id"),
+        )
+        .values(priority=bindparam("b_priority")),
+        [{"b_record_id": it.record_id, "b_priority": it.priority} for it in priorities],
+    )
+    session.commit()
+
+    return {"ok": True, "num_updated": updated.rowcount}
+
+
 @app.patch(
     "/queuesteps/{queuestep_id}",
     response_model=QueueStepReadWithLabelQueue,
@@ -294,8 +798,31 @@ def update_queuestep(
         raise HTTPException(status_code=404, detail="QueueStep not found")
 
     queuestep_dict = queuestep.dict(exclude_unset=True)
+    policy = (db_queuestep.type, db_queuestep.policy_args)
+    if "type" in queuestep_dict or "policy_args" in queuestep_dict:
+        queue_type = queuestep_dict.get("type") or db_queuestep.type
+        # the stored arguments are kept only while the policy stays the same
+        policy_args = queuestep_dict.get(
+            "policy_args",
+            db_queuestep.policy_args if queue_type == db_queuestep.type else None,
+        )
+        try:
+            queuestep_dict["type"] = queue_type
+            queuestep_dict["policy_args"] = QueueStep.parse_policy_args(
+                queue_type, policy_args
+            )
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=jsonable_encoder(e.errors()))
+
     for k, v in queuestep_dict.items():
         setattr(db_queuestep, k, v)
+    if (db_queuestep.type, db_queuestep.policy_args) != policy:
+        session.flush()
+        db_queuestep.rebuild_frontier()
+    # a change in size can fill or reopen the queuestep
+    db_queuestep.completed = (
+        db_queuestep.num_records_assigned >= db_queuestep.get_capacity()
+    )
 
     session.add(db_queuestep)
     session.commit()
@@ -308,6 +835,14 @@ def delete_queuestep(*, session: Session = Depends(get_session), queuestep_id: i
     queuestep = session.get(QueueStep, queuestep_id)
     if not queuestep:
         raise HTTPException(status_code=404, detail="QueueStep not found")
+    session.execute(
+        delete(FrontierRecord).where(FrontierRecord.queuestep_id == queuestep_id)
+    )
+    session.execute(
+        delete(QueueStepUserStats).where(
+            QueueStepUserStats.queuestep_id == queuestep_id
+        )
+    )
     session.delete(queuestep)
     session.commit()
     return {"ok": True}
@@ -380,6 +915,7 @@ def delete_labelqueue(*, session: Session = Depends(get_session), labelqueue_id:
     labelqueue = session.get(LabelQueue, labelqueue_id)
     if not labelqueue:
         raise HTTPException(status_code=404, detail="LabelQueue not found")
+    labelqueue.clear_frontier()
     session.delete(labelqueue)
     session.commit()
     return {"ok": True}
@@ -459,9 +995,10 @@ def create_queuestep(
 
     # can only create steps at the end
     # a different method will handle changing order
-    rank = 1
-    if len(labelqueue.queuesteps) > 0:
-        rank += max(labelqueue.queuesteps, key=lambda x: x.rank).rank
+    last_rank = session.exec(
+        select(func.max(QueueStep.rank)).where(QueueStep.labelqueue_id == labelqueue_id)
+    ).one()
+    rank = (last_rank or 0) + 1
 
     # add fields needed for db then commit
     queuestep = QueueStep.from_orm(queuestep)
@@ -471,41 +1008,42 @@ def create_queuestep(
     # jsonable_encoder allows for insertion of pydantic model into json field
     queuestep.policy_args = jsonable_encoder(queuestep.policy_args)
     session.add(queuestep)
+    session.flush()
+    queuestep.seed_frontier()
     session.commit()
     session.refresh(queuestep)
 
-    return queuestep
+    task_waiters.notify(queuestep.labelqueue_id)
 
+    return queuestep
 
-@app.post(
-    "/labelqueues/{labelqueue_id}/{user_id}/task/",
-    response_model=TaskReadWithRelations,
-    tags=["LabelQueue"],
-)
-def create_task(
-    *, session: Session = Depends(get_session), labelqueue_id: int, user_id: int
-):
-    # TODO: it should not be possible to create more tasks than the queuestep has capacity for.
 
-    # check preconditions
+def check_task_preconditions(session: Session, labelqueue_id: int, user_id: int):
+    """
+    Check that a task can be created for the user and return the labelqueue and its active
+    queuestep. Every check is a primary key or LIMIT 1 probe so that the check stays cheap
+    on large labelqueues.
+    """
     labelqueue = session.get(LabelQueue, labelqueue_id)
     if not labelqueue:
         raise HTTPException(status_code=404, detail="Labelqueue not found")
 
-    labelqueue_users = {user.id for user in labelqueue.users}
-    if user_id not in labelqueue_users:
+    if session.get(LabelQueueUserLink, (labelqueue_id, user_id)) is None:
         raise HTTPException(
             status_code=404,
             detail="The provided user does not belong to the labelqueue.",
         )
 
-    if labelqueue.dataset is None:
+    if labelqueue.dataset_id is None:
         raise HTTPException(
             status_code=406,
             detail="Cannot create a task because this labelqueue does not have a registered dataset.",
         )
 
-    if len(labelqueue.dataset.records) == 0:
+    has_records = session.exec(
+        select(Record.id).where(Record.dataset_id == labelqueue.dataset_id).limit(1)
+    ).first()
+    if has_records is None:
         raise HTTPException(
             status_code=406,
             detail="Cannot create a task because the registered dataset does not have any records.",
@@ -518,29 +1056,420 @@ def create_task(
             detail="Cannot create a task because this labelqueue does not have an active queue step.",
         )
 
-    # get the next task from the queue
+    return labelqueue, queuestep
+
+
+@app.post(
+    "/labelqueues/{labelqueue_id}/{user_id}/task/",
+    response_model=TaskReadWithReservations,
+    tags=["LabelQueue"],
+)
+def create_task(
+    *,
+    session: Session = Depends(get_session),
+    labelqueue_id: int,
+    user_id: int,
+    idempotency_key: Optional[str] = Header(default=None),
+    reserve: int = Query(default=0, ge=0, le=100),
+):
+    """
+    Assign the next task to the user. A user that still has an incomplete task in the
+    labelqueue gets that task back, so retried requests do not allocate new records. With an
+    Idempotency-Key header, a retry returns the task created by the original request.
+
+    With reserve=K the next K records are soft-reserved for the user and returned with their
+    data, so that the client can render the next item while the current one is submitted.
+    The following requests hand out the reservations in order; reservations that are not
+    handed out in time are released with the expired leases.
+    """
+    labelqueue = session.get(LabelQueue, labelqueue_id)
+    task = None
+    if labelqueue:
+        task = labelqueue.get_outstanding_task(user_id, idempotency_key)
+
+    if task is None:
+        labelqueue, queuestep = check_task_preconditions(
+            session, labelqueue_id, user_id
+        )
+
+        # claim the next task from the queue
+        try:
+            task: Union[Task, None] = labelqueue.create_task(user_id, queuestep)
+        except Exception as e:
+            raise HTTPException(
+                status_code=406,
+                detail=f"Unable to get task assignment. Reason: {repr(e)}",
+            )
+
+        # TODO: This indicates that the queue is empty. There should be a custom object to make this more explicit to the client.
+        if task is None:
+            raise HTTPException(status_code=406, detail="Queue is empty.")
+
+        task.idempotency_key = idempotency_key
+        try:
+            session.commit()
+        except IntegrityError:
+            # a concurrent retry with the same idempotency key won the race
+            session.rollback()
+            task = labelqueue.get_outstanding_task(user_id, idempotency_key)
+
+    labelqueue.activate_task(task, idempotency_key)
+    reservations = []
+    if reserve:
+        reservations = labelqueue.reserve_tasks(
+            user_id, reserve, labelqueue.get_active_queuestep()
+        )
+    session.commit()
+    session.refresh(task)
+
+    return TaskReadWithReservations(
+        **TaskReadWithRelations.from_orm(task).dict(),
+        reservations=[TaskReadWithRecord.from_orm(it) for it in reservations],
+    )
+
+
+@app.post(
+    "/labelqueues/{labelqueue_id}/{user_id}/task/wait",
+    response_model=TaskReadWithReservations,
+    tags=["LabelQueue"],
+)
+async def wait_for_task(
+    *,
+    session: Session = Depends(get_session),
+    labelqueue_id: int,
+    user_id: int,
+    timeout: float = Query(default=30, gt=0, le=300),
+    idempotency_key: Optional[str] = Header(default=None),
+    reserve: int = Query(default=0, ge=0, le=100),
+):
+    """
+    Long-poll variant of create_task. If no task can be assigned, the request waits up to
+    timeout seconds and retries when records are added to the labelqueue, a queue step is
+    created, or tasks are released. Responds with the last 406 if the timeout runs out.
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        # register before claiming so that a notification during the claim is not missed
+        waiter = task_waiters.register(labelqueue_id)
+        try:
+            return await run_in_threadpool(
+                create_task,
+                session=session,
+                labelqueue_id=labelqueue_id,
+                user_id=user_id,
+                idempotency_key=idempotency_key,
+                reserve=reserve,
+            )
+        except HTTPException as e:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if e.status_code != 406 or remaining <= 0:
+                raise
+
+            # do not hold the failed claim's transaction while waiting
+            await run_in_threadpool(session.rollback)
+            if not await task_waiters.wait(waiter, remaining):
+                raise
+        finally:
+            task_waiters.discard(labelqueue_id, waiter)
+
+
+@app.post(
+    "/labelqueues/{labelqueue_id}/{user_id}/tasks/",
+    response_model=List[TaskReadWithRelations],
+    tags=["LabelQueue"],
+)
+def create_tasks(
+    *,
+    session: Session = Depends(get_session),
+    labelqueue_id: int,
+    user_id: int,
+    num_tasks: int = Query(default=10, gt=0, le=1000),
+):
+    """
+    Claim up to num_tasks tasks for the user in a single transaction.
+    Fewer tasks are returned if the queue runs out of records.
+    """
+    labelqueue, queuestep = check_task_preconditions(session, labelqueue_id, user_id)
+
     try:
-        next_task: NextTask = labelqueue.get_next_task(user_id)
+        tasks: List[Task] = labelqueue.create_tasks(user_id, num_tasks, queuestep)
     except Exception as e:
         raise HTTPException(
             status_code=406, detail=f"Unable to get task assignment. Reason: {repr(e)}"
         )
 
-    # TODO: This indicates that the queue is empty. There should be a custom object to make this more explicit to the client.
-    if next_task is None:
+    if not tasks:
         raise HTTPException(status_code=406, detail="Queue is empty.")
 
-    task = Task(
-        record_id=next_task.record_id,
-        dataset_id=next_task.dataset_id,
-        user_id=user_id,
-        queuestep_id=next_task.queuestep_id,
-        labelqueue_id=labelqueue_id,
+    session.commit()
+    for task in tasks:
+        session.refresh(task)
+
+    return [TaskReadWithRelations.from_orm(task) for task in tasks]
+
+
+def fill_task_channel(
+    session: Session, labelqueue_id: int, user_id: int, tasks: List[Task]
+) -> List[Task]:
+    """
+    Top up a task channel to its current task plus one prefetched task. The user's
+    outstanding tasks are reused before new ones are claimed, so a reconnecting labeler picks
+    up where they left off.
+    """
+    labelqueue, queuestep = check_task_preconditions(session, labelqueue_id, user_id)
+
+    tasks = refresh_channel_tasks(session, tasks)
+    task_ids = {task.id for task in tasks}
+    for task in labelqueue.get_outstanding_tasks(user_id, TASK_CHANNEL_SIZE):
+        if len(tasks) < TASK_CHANNEL_SIZE and task.id not in task_ids:
+            labelqueue.activate_task(task)
+            tasks.append(task)
+
+    if len(tasks) < TASK_CHANNEL_SIZE:
+        tasks += labelqueue.create_tasks(
+            user_id, TASK_CHANNEL_SIZE - len(tasks), queuestep
+        )
+    session.commit()
+
+    return tasks
+
+
+def refresh_channel_tasks(session: Session, tasks: List[Task]) -> List[Task]:
+    """
+    Reload the tasks of a channel, dropping the ones that are gone, e.g. a prefetched task
+    whose lease expired and that was released by the lease sweeper.
+    """
+    refreshed = []
+    for task in tasks:
+        try:
+            session.refresh(task)
+        except InvalidRequestError:
+            session.expunge(task)
+            continue
+        refreshed.append(task)
+
+    return refreshed
+
+
+def activate_channel_task(session: Session, tasks: List[Task]) -> List[Task]:
+    """
+    Make the prefetched task the channel's current task once the previous one is completed.
+    Its lease is renewed, since it was taken when the task was claimed; if the task was
+    released in the meantime, it is dropped and the channel is refilled.
+    """
+    tasks = refresh_channel_tasks(session, tasks)
+    if tasks:
+        tasks[0].labelqueue.activate_task(tasks[0])
+        session.commit()
+
+    return tasks
+
+
+def release_channel_tasks(session: Session, tasks: List[Task]):
+    """
+    Return the prefetched tasks of a closed channel to their queue.
+    """
+    for task in refresh_channel_tasks(session, tasks):
+        if task.completed:
+            continue
+        queuestep = task.queuestep
+        record_id, user_id = task.record_id, task.user_id
+        session.delete(task)
+        session.flush()
+        queuestep.release_records([record_id], [user_id])
+    session.commit()
+
+
+def complete_channel_task(session: Session, completion: TaskComplete):
+    results = complete_tasks(session, [completion])
+    session.commit()
+    return results
+
+
+@app.websocket("/labelqueues/{labelqueue_id}/{user_id}/ws")
+async def task_channel(
+    *,
+    session: Session = Depends(get_session),
+    websocket: WebSocket,
+    labelqueue_id: int,
+    user_id: int,
+):
+    """
+    Assignment channel for one labeler. The server pushes the current task as a
+    TaskReadWithRelations payload and keeps the following task claimed. Sending a
+    TaskComplete payload for the current task completes it and is answered with the next task
+    right away. Problems are reported as {"detail": ...}; when the queue is empty the channel
+    stays open and pushes a task as soon as work becomes available.
+    """
+    await websocket.accept()
+
+    tasks: List[Task] = []
+    pushed_task_id = None
+    sent_detail = None
+    waiter = None
+
+    async def push_current_task():
+        nonlocal pushed_task_id, sent_detail
+        pushed_task_id = tasks[0].id
+        sent_detail = None
+        task = await run_in_threadpool(TaskReadWithRelations.from_orm, tasks[0])
+        await websocket.send_json(jsonable_encoder(task))
+
+    try:
+        while True:
+            # register before claiming so that a notification during the claim is not missed
+            waiter = task_waiters.register(labelqueue_id)
+            detail = None
+            try:
+                tasks = await run_in_threadpool(
+                    fill_task_channel, session, labelqueue_id, user_id, tasks
+                )
+            except HTTPException as e:
+                await run_in_threadpool(session.rollback)
+                if e.status_code != 406:
+                    await websocket.send_json({"detail": e.detail})
+                    await websocket.close(code=1008)
+                    return
+                detail = e.detail
+
+            if tasks and tasks[0].id != pushed_task_id:
+                await push_current_task()
+            elif not tasks and sent_detail != (detail or "Queue is empty."):
+                sent_detail = detail or "Queue is empty."
+                await websocket.send_json({"detail": sent_detail})
+
+            # with nothing to label, wait for work while still noticing a closed socket
+            receive = asyncio.ensure_future(websocket.receive_text())
+            if not tasks:
+                done, _ = await asyncio.wait(
+                    {receive, waiter}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if receive not in done:
+                    receive.cancel()
+                    continue
+            task_waiters.discard(labelqueue_id, waiter)
+
+            try:
+                # frames that are not JSON are reported like invalid payloads
+                completion = TaskComplete.parse_raw(await receive)
+            except ValidationError as e:
+                await websocket.send_json({"detail": jsonable_encoder(e.errors())})
+                continue
+            if not tasks or completion.id != tasks[0].id:
+                await websocket.send_json(
+                    {"detail": "Only the current task can be completed."}
+                )
+                continue
+
+            (result,) = await run_in_threadpool(
+                complete_channel_task, session, completion
+            )
+            if not result.ok:
+                await websocket.send_json({"detail": result.detail})
+            tasks = await run_in_threadpool(activate_channel_task, session, tasks[1:])
+
+            # the prefetched task is pushed before the channel claims the one after it
+            if tasks:
+                await push_current_task()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if waiter is not None:
+            task_waiters.discard(labelqueue_id, waiter)
+        # the current task stays with the user; the prefetched one goes back to the queue
+        await run_in_threadpool(session.rollback)
+        await run_in_threadpool(release_channel_tasks, session, tasks[1:])
+
+
+#
+# Tasks
+#
+@app.patch("/tasks/{task_id}", response_model=TaskRead, tags=["Task"])
+def complete_task(
+    *, session: Session = Depends(get_session), task_id: int, task: TaskUpdate
+):
+    """
+    Complete a task with its completed data payload.
+    """
+    db_task = session.get(Task, task_id)
+    if not db_task:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    (result,) = complete_tasks(
+        session, [TaskComplete(id=task_id, completed_data=task.completed_data)]
     )
+    if not result.ok:
+        raise HTTPException(status_code=406, detail=result.detail)
 
-    # add fields needed for db then commit
+    session.commit()
+    session.refresh(db_task)
+
+    return db_task
+
+
+@app.post("/tasks/complete/", response_model=List[TaskCompleteResult], tags=["Task"])
+def complete_tasks_bulk(
+    *, session: Session = Depends(get_session), tasks: List[TaskComplete]
+):
+    """
+    Complete many tasks in one transaction, e.g. labels that were collected offline.
+    Returns one outcome per submitted task; tasks that do not exist or are already completed
+    are reported and skipped without failing the rest of the batch.
+    """
+    results = complete_tasks(session, tasks)
+    session.commit()
+
+    return results
+
+
+@app.delete("/tasks/{task_id}", tags=["Task"])
+def release_task(*, session: Session = Depends(get_session), task_id: int):
+    """
+    Release an incomplete task. The task is deleted and its record is returned to the frontier
+    of the labelqueue so that it can be assigned again.
+    """
+    task = session.get(Task, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    if task.completed:
+        raise HTTPException(status_code=406, detail="Cannot release a completed task.")
+
+    queuestep = task.queuestep
+    record_id, user_id = task.record_id, task.user_id
+    session.delete(task)
+    session.flush()
+    queuestep.release_records([record_id], [user_id])
+    session.commit()
+
+    task_waiters.notify(queuestep.labelqueue_id)
+
+    return {"ok": True}
+
+
+@app.post("/tasks/{task_id}/lease", response_model=TaskRead, tags=["Task"])
+def renew_task_lease(*, session: Session = Depends(get_session), task_id: int):
+    """
+    Heartbeat for an incomplete task: extend its lease by the labelqueue's lease duration.
+    """
+    task = session.get(Task, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    if task.completed:
+        raise HTTPException(
+            status_code=406, detail="Cannot renew the lease of a completed task."
+        )
+
+    lease_expires_at = task.labelqueue.get_lease_expiry()
+    if lease_expires_at is None:
+        raise HTTPException(
+            status_code=406, detail="The labelqueue does not use task leases."
+        )
+
+    task.lease_expires_at = lease_expires_at
     session.add(task)
     session.commit()
     session.refresh(task)
 
-    return TaskReadWithRelations.from_orm(task)
+    return task
@@ -1,9 +1,27 @@
-from typing import Optional, List, Dict, Annotated, Union
+from typing import Optional, List, Dict, Annotated, Union, ClassVar, Tuple
 import enum
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import blake2b
+import json
 import random
 
-from pydantic import BaseModel, EmailStr, validator
+from pydantic import BaseModel, EmailStr, conint, validator
+from sqlalchemy import (
+    Index,
+    UniqueConstraint,
+    and_,
+    bindparam,
+    delete,
+    exists,
+    func,
+    insert,
+    literal,
+    or_,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import object_session
 from sqlmodel import (
     Field,
     Relationship,
@@ -13,28 +31,48 @@ from sqlmodel import (
     SQLModel,
     JSON,
     Integer,
+    BigInteger,
     DateTime,
+    select,
 )
 
+from compression import CompressedJSON
+
 
 #
 # Record models - records represent individual data items
 #
 class RecordBase(SQLModel):
-    data: Dict = Field(default={}, sa_column=Column(JSON))
+    data: Dict = Field(default={}, sa_column=Column(CompressedJSON))
 
     class Config:
         validate_assignment = True
 
 
 class Record(RecordBase, table=True):
+    # duplicate payloads are rejected with one probe per record in datasets with dedupe;
+    # the hash is NULL elsewhere, and NULLs never conflict
+    __table_args__ = (
+        Index(
+            "ix_record_dataset_id_content_hash",
+            "dataset_id",
+            "content_hash",
+            unique=True,
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True, index=True)
     # records are required to belong to a dataset
     dataset_id: int = Field(default=None, foreign_key="dataset.id", index=True)
+    content_hash: Optional[str] = None
 
     dataset: "Dataset" = Relationship(back_populates="records")
     tasks: "Task" = Relationship(back_populates="record")
 
+    # optional blobs.BlobStore that large string fields of new records are moved to, leaving
+    # {"$blob": digest} references in the data
+    blob_store: ClassVar = None
+
 
 class RecordRead(RecordBase):
     id: int
@@ -48,6 +86,42 @@ class RecordUpdate(RecordBase):
     data: Optional[Dict]
 
 
+def content_hash(data: Dict) -> str:
+    """
+    Hash of the canonical JSON of a record's data, so that equal payloads hash the same
+    regardless of key order or whitespace.
+    """
+    canonical = json.dumps(
+        data, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+class InsertedRecords(BaseModel):
+    num_records: int = 0
+    first_record_id: Optional[int] = None
+    last_record_id: Optional[int] = None
+
+
+def parse_records(records) -> List[Dict]:
+    """
+    Data payloads of a decoded JSON list of RecordCreate objects. The payloads are checked
+    with plain type checks in one pass instead of validating a pydantic model per record.
+    Raises ValueError naming the first invalid record.
+    """
+    if not isinstance(records, list):
+        raise ValueError("Expected a list of records.")
+
+    datas = [
+        record.get("data", {}) if type(record) is dict else None for record in records
+    ]
+    for i, data in enumerate(datas):
+        if type(data) is not dict:
+            raise ValueError(f"Record {i} is not an object with a data object.")
+
+    return datas
+
+
 #
 # Dataset models
 # we add a dataset model to collect a set of records
@@ -55,6 +129,8 @@ class RecordUpdate(RecordBase):
 class DatasetBase(SQLModel):
     name: str
     description: Optional[str]
+    # skip records whose data duplicates a record already in the dataset
+    dedupe: bool = False
 
     class Config:
         validate_assignment = True
@@ -67,6 +143,130 @@ class Dataset(DatasetBase, table=True):
     labelqueues: List["LabelQueue"] = Relationship(back_populates="dataset")
     tasks: List["Task"] = Relationship(back_populates="dataset")
 
+    def get_last_record_id(self) -> int:
+        """
+        The id of the dataset's newest record, or 0 if it has none.
+        """
+        last_record_id = (
+            object_session(self)
+            .exec(select(func.max(Record.id)).where(Record.dataset_id == self.id))
+            .one()
+        )
+
+        return last_record_id or 0
+
+    def insert_records(self, records: List[Dict]) -> InsertedRecords:
+        """
+        Insert the data payloads of new records with a single Core executemany, without
+        building an ORM object per record. With dedupe, payloads that are already in the
+        dataset are skipped by the unique (dataset_id, content_hash) index. Returns the number
+        and id range of the inserted records. The ids are contiguous on SQLite, where the
+        insert holds the write lock; elsewhere the range may include records inserted
+        concurrently into the same dataset. Large fields are offloaded to the blob store before
+        hashing; blobs are content-addressed, so equal payloads still hash the same.
+        """
+        if not records:
+            return InsertedRecords()
+
+        session = object_session(self)
+        last_record_id = self.get_last_record_id()
+        if Record.blob_store is not None:
+            records = [Record.blob_store.offload(data) for data in records]
+        if self.dedupe:
+            # duplicates within the upload are dropped here, the others by the unique index
+            unique_records: Dict[str, Dict] = {}
+            for data in records:
+                unique_records.setdefault(content_hash(data), data)
+            session.execute(
+                dialect_insert(session, Record.__table__).on_conflict_do_nothing(),
+                [
+                    {"dataset_id": self.id, "data": data, "content_hash": digest}
+                    for digest, data in unique_records.items()
+                ],
+            )
+        else:
+            session.execute(
+                insert(Record.__table__),
+                [{"dataset_id": self.id, "data": data} for data in records],
+            )
+
+        num_records, first_record_id, last_record_id = session.execute(
+            select(
+                func.count(Record.id), func.min(Record.id), func.max(Record.id)
+            ).where(Record.dataset_id == self.id, Record.id > last_record_id)
+        ).one()
+
+        return InsertedRecords(
+            num_records=num_records,
+            first_record_id=first_record_id,
+            last_record_id=last_record_id,
+        )
+
+    def backfill_content_hashes(self, chunk_size=1000):
+        """
+        Hash the records that were added before dedupe was turned on. Records whose data
+        duplicates an earlier record keep a NULL hash, since the unique index only admits the
+        first of them.
+        """
+        session = object_session(self)
+        last_record_id = 0
+        while True:
+            chunk = session.execute(
+                select(Record.id, Record.data)
+                .where(
+                    Record.dataset_id == self.id,
+                    Record.content_hash == None,
+                    Record.id > last_record_id,
+                )
+                .order_by(Record.id)
+                .limit(chunk_size)
+            ).all()
+            if not chunk:
+                return
+            last_record_id = chunk[-1][0]
+
+            record_ids: Dict[str, int] = {}
+            for record_id, data in chunk:
+                record_ids.setdefault(content_hash(data), record_id)
+            existing = session.exec(
+                select(Record.content_hash).where(
+                    Record.dataset_id == self.id,
+                    Record.content_hash.in_(list(record_ids)),
+                )
+            ).all()
+            for digest in existing:
+                del record_ids[digest]
+
+            if record_ids:
+                session.execute(
+                    update(Record.__table__)
+                    .where(Record.id == bindparam("b_id"))
+                    .values(content_hash=bindparam("b_content_hash")),
+                    [
+                        {"b_id": record_id, "b_content_hash": digest}
+                        for digest, record_id in record_ids.items()
+                    ],
+                )
+
+    def ingest_records(self, records: List[Dict]) -> InsertedRecords:
+        """
+        Insert records and seed them into the frontiers of the dataset's labelqueues.
+        """
+        inserted = self.insert_records(records)
+        if inserted.num_records:
+            self.seed_frontier(
+                Record.id.between(inserted.first_record_id, inserted.last_record_id)
+            )
+
+        return inserted
+
+    def seed_frontier(self, *criteria):
+        """
+        Make records available to every labelqueue that uses the dataset.
+        """
+        for labelqueue in self.labelqueues:
+            labelqueue.seed_frontier(*criteria)
+
 
 class DatasetRead(DatasetBase):
     id: int
@@ -84,6 +284,127 @@ class DatasetUpdate(DatasetBase):
     name: Optional[str]
 
 
+#
+# Ingest jobs - large record uploads ingested in the background
+#
+class IngestStatus(enum.Enum):
+    pending = "Pending"
+    running = "Running"
+    completed = "Completed"
+    failed = "Failed"
+
+
+class RecordFormat(enum.Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+    parquet = "parquet"
+
+
+class IngestJobBase(SQLModel):
+    dataset_id: int = Field(foreign_key="dataset.id", index=True)
+    format: RecordFormat = Field(
+        default=RecordFormat.ndjson, sa_column=Column(Enum(RecordFormat))
+    )
+
+
+class IngestJob(IngestJobBase, table=True):
+    """
+    IngestJob models
+    - an NDJSON, CSV or Parquet upload spooled to disk and ingested into a dataset by a
+      background worker
+    - progress is committed together with each ingested chunk, so an interrupted job resumes
+      after the last row that was ingested
+    - a worker claims a job before running it and sends a heartbeat with each chunk; running
+      jobs without a recent heartbeat are resumed by the next worker that claims them
+    """
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    status: IngestStatus = Field(
+        default=IngestStatus.pending, sa_column=Column(Enum(IngestStatus))
+    )
+    # location of the spooled upload; removed once the job has finished
+    path: str
+    created_at: datetime = Field(
+        sa_column=Column(DateTime, nullable=False, default=datetime.utcnow)
+    )
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
+    # rows read from the upload: lines for NDJSON, rows after the header for CSV
+    num_lines: int = 0
+    num_records: int = 0
+    num_duplicates: int = 0
+    num_errors: int = 0
+    # the first MAX_INGEST_ERRORS invalid lines with their validation errors
+    errors: List[Dict] = Field(default=[], sa_column=Column(JSON))
+
+    def get_records_per_second(self) -> Union[float, None]:
+        """
+        Ingest throughput since the job started, or None if it has not started.
+        """
+        if self.started_at is None:
+            return None
+
+        elapsed = (self.finished_at or datetime.utcnow()) - self.started_at
+        return self.num_records / max(elapsed.total_seconds(), 1e-6)
+
+
+# number of invalid lines whose errors are kept on an ingest job
+MAX_INGEST_ERRORS = 100
+# seconds without a heartbeat after which a running ingest job is considered abandoned
+INGEST_HEARTBEAT_TIMEOUT = 300
+
+
+def ingest_job_claimable(now: datetime):
+    """
+    Condition of the ingest jobs a worker may claim: pending jobs, and running jobs whose
+    worker stopped sending heartbeats.
+    """
+    return or_(
+        IngestJob.status == IngestStatus.pending,
+        and_(
+            IngestJob.status == IngestStatus.running,
+            or_(
+                IngestJob.heartbeat_at == None,
+                IngestJob.heartbeat_at
+                < now - timedelta(seconds=INGEST_HEARTBEAT_TIMEOUT),
+            ),
+        ),
+    )
+
+
+def claim_ingest_job(session, job_id: int, now: datetime = None) -> bool:
+    """
+    Claim an ingest job for this worker: a pending job, or a running job whose worker stopped
+    sending heartbeats. The claim is a conditional update, so a job runs in one worker only,
+    even when every worker tries to resume it at once.
+    """
+    now = now or datetime.utcnow()
+    claimed = session.execute(
+        update(IngestJob.__table__)
+        .where(IngestJob.id == job_id, ingest_job_claimable(now))
+        .values(status=IngestStatus.running, heartbeat_at=now)
+    )
+    session.commit()
+
+    return claimed.rowcount > 0
+
+
+class IngestJobRead(IngestJobBase):
+    id: int
+    status: IngestStatus
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+    heartbeat_at: Optional[datetime]
+    num_lines: int
+    num_records: int
+    num_duplicates: int
+    num_errors: int
+    errors: List[Dict]
+    records_per_second: Optional[float]
+
+
 #
 # Link models for LabelQueue, dataset, and user many-to-many relationships
 #
@@ -115,6 +436,38 @@ class TaskBase(SQLModel):
 
 
 class Task(TaskBase, table=True):
+    # supports the "has this record been assigned in this labelqueue" anti-join
+    __table_args__ = (
+        Index("ix_task_labelqueue_id_record_id", "labelqueue_id", "record_id"),
+        # serves the sweep for expired leases
+        Index("ix_task_completed_lease_expires_at", "completed", "lease_expires_at"),
+        # serve the lookup of a user's outstanding tasks, per labelqueue and overall
+        Index(
+            "ix_task_labelqueue_id_user_id_completed",
+            "labelqueue_id",
+            "user_id",
+            "completed",
+        ),
+        Index("ix_task_user_id_completed", "user_id", "completed"),
+        # a retried task request with the same idempotency key returns the same task
+        Index(
+            "ix_task_labelqueue_id_user_id_idempotency_key",
+            "labelqueue_id",
+            "user_id",
+            "idempotency_key",
+            unique=True,
+        ),
+        # a user is assigned a record at most once per queuestep; also serves the consensus
+        # "not yet labeled by this user" anti-join
+        Index(
+            "ix_task_queuestep_id_user_id_record_id",
+            "queuestep_id",
+            "user_id",
+            "record_id",
+            unique=True,
+        ),
+    )
+
     # id variables
     id: Optional[int] = Field(default=None, primary_key=True, index=True)
     record_id: int = Field(default=None, foreign_key="record.id")
@@ -129,7 +482,13 @@ class Task(TaskBase, table=True):
         index=True,
     )
     completed: bool = Field(default=False, index=True)
-    completed_data: Dict = Field(default={}, sa_column=Column(JSON))
+    completed_data: Dict = Field(default={}, sa_column=Column(CompressedJSON))
+    # incomplete tasks are returned to the queue once their lease expires
+    lease_expires_at: Optional[datetime] = None
+    idempotency_key: Optional[str] = None
+    # soft reservation of a record the user is expected to label next; it always carries a
+    # lease and becomes a regular task once it is handed out as the user's current task
+    reserved: bool = False
 
     # relationships
     record: "Record" = Relationship(back_populates="tasks")
@@ -144,12 +503,259 @@ class TaskRead(TaskBase):
     created_at: datetime
     completed: bool
     completed_data: Dict
+    lease_expires_at: Optional[datetime]
+    reserved: bool
 
 
 class TaskUpdate(TaskBase):
     completed_data: Optional[Dict]
 
 
+class TaskComplete(TaskUpdate):
+    id: int
+
+
+class TaskCompleteResult(BaseModel):
+    id: int
+    ok: bool
+    detail: Optional[str]
+
+
+#
+# Frontier
+#
+def record_priority(policy_args: "PolicyArgsPriority", data: Dict) -> float:
+    """
+    Priority of a record under the priority policy arguments.
+    """
+    value = (data or {}).get(policy_args.field) if policy_args.field else None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+
+    return policy_args.default
+
+
+def permutation_position(seed: int, record_id: int) -> int:
+    """
+    Position of a record in the pseudo-random order keyed by seed.
+    The keyed hash is truncated to 63 bits so that it fits a signed 64-bit integer column.
+    """
+    digest = blake2b(
+        record_id.to_bytes(8, "little"), digest_size=8, key=seed.to_bytes(8, "little")
+    ).digest()
+    return int.from_bytes(digest, "little") >> 1
+
+
+class FrontierRecord(SQLModel, table=True):
+    """
+    FrontierRecord models
+    - a record that a queuestep may still assign
+    - rows are seeded when a record becomes visible to the queuestep and removed once it has been
+      assigned as many times as the queuestep policy requires
+    - records are ordered by their assignments so far, then by descending priority, then by
+      position, so that the next record is a single index seek
+    """
+
+    __table_args__ = (
+        Index(
+            "ix_frontierrecord_queuestep_id_order",
+            "queuestep_id",
+            "num_assigned",
+            text("priority DESC"),
+            "position",
+            "record_id",
+        ),
+        Index(
+            "ix_frontierrecord_labelqueue_id_record_id", "labelqueue_id", "record_id"
+        ),
+    )
+
+    queuestep_id: int = Field(foreign_key="queuestep.id", primary_key=True)
+    record_id: int = Field(foreign_key="record.id", primary_key=True, index=True)
+    labelqueue_id: int = Field(foreign_key="labelqueue.id")
+    position: int = Field(sa_column=Column(BigInteger, nullable=False))
+    num_assigned: int = 0
+    priority: float = 0
+
+
+# the order in which a queuestep assigns its frontier; matches the frontier ordering index
+FRONTIER_ORDER = (
+    FrontierRecord.num_assigned,
+    FrontierRecord.priority.desc(),
+    FrontierRecord.position,
+    FrontierRecord.record_id,
+)
+
+
+def dialect_insert(session, table):
+    """
+    INSERT statement of the session's dialect, which supports ON CONFLICT clauses.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(table)
+
+    return sqlite.insert(table)
+
+
+#
+# Per-user counters
+#
+class QueueStepUserStats(SQLModel, table=True):
+    """
+    QueueStepUserStats models
+    - the number of tasks a user was assigned and completed in a queuestep
+    - maintained alongside the queuestep counters so that per-user quotas are enforced without
+      counting tasks; released tasks are recounted from the (queuestep_id, user_id) task index
+    """
+
+    queuestep_id: int = Field(foreign_key="queuestep.id", primary_key=True)
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    num_assigned: int = 0
+    num_completed: int = 0
+
+
+# lifetime in seconds of a reservation in a labelqueue without leases
+RESERVATION_DURATION = 600
+
+
+def release_expired_tasks(session, now: datetime = None, chunk_size=1000) -> int:
+    """
+    Delete incomplete tasks whose lease has expired and return their records to the frontier.
+    Returns the number of released tasks. Expired tasks are found through the
+    (completed, lease_expires_at) index and released in chunks.
+    """
+    now = now or datetime.utcnow()
+    expired_clause = (Task.completed == False, Task.lease_expires_at < now)
+
+    num_released = 0
+    while True:
+        expired = session.execute(
+            select(Task.id, Task.queuestep_id, Task.record_id, Task.user_id)
+            .where(*expired_clause)
+            .limit(chunk_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not expired:
+            break
+
+        task_ids = [task_id for task_id, _, _, _ in expired]
+        deleted = session.execute(
+            delete(Task).where(Task.id.in_(task_ids), *expired_clause)
+        )
+        if deleted.rowcount < len(expired):
+            # some tasks were completed or renewed in the meantime; the delete holds the write
+            # lock, so the tasks that are left are exactly the ones that were not released
+            kept = set(session.exec(select(Task.id).where(Task.id.in_(task_ids))).all())
+            expired = [task for task in expired if task[0] not in kept]
+
+        record_ids_by_queuestep: Dict[int, List[int]] = {}
+        user_ids_by_queuestep: Dict[int, set] = {}
+        for _, queuestep_id, record_id, user_id in expired:
+            record_ids_by_queuestep.setdefault(queuestep_id, []).append(record_id)
+            user_ids_by_queuestep.setdefault(queuestep_id, set()).add(user_id)
+        for queuestep_id, record_ids in record_ids_by_queuestep.items():
+            queuestep = session.get(QueueStep, queuestep_id)
+            if queuestep is not None:
+                queuestep.release_records(
+                    record_ids, user_ids_by_queuestep[queuestep_id]
+                )
+        session.commit()
+
+        num_released += len(expired)
+
+    return num_released
+
+
+def complete_tasks(
+    session, completions: List[TaskComplete], chunk_size=500
+) -> List[TaskCompleteResult]:
+    """
+    Complete many tasks in the session's transaction and report the outcome per task.
+    Task states are read in chunks, written with one executemany update, and the queuestep
+    completion counters are advanced once per queuestep. If a task appears more than once,
+    its first completion is used. The session should not hold other pending changes because
+    a conflicting concurrent completion rolls the session back.
+    """
+    pending_by_id: Dict[int, TaskComplete] = {}
+    for completion in completions:
+        pending_by_id.setdefault(completion.id, completion)
+
+    results: Dict[int, TaskCompleteResult] = {}
+    queuestep_ids: Dict[int, int] = {}
+    user_ids: Dict[int, int] = {}
+    task_ids = list(pending_by_id)
+    for start in range(0, len(task_ids), chunk_size):
+        chunk = task_ids[start : start + chunk_size]
+        for task_id, queuestep_id, user_id, completed in session.execute(
+            select(Task.id, Task.queuestep_id, Task.user_id, Task.completed).where(
+                Task.id.in_(chunk)
+            )
+        ):
+            if completed:
+                results[task_id] = TaskCompleteResult(
+                    id=task_id, ok=False, detail="Task is already completed."
+                )
+            else:
+                queuestep_ids[task_id] = queuestep_id
+                user_ids[task_id] = user_id
+
+    for task_id in task_ids:
+        if task_id not in results and task_id not in queuestep_ids:
+            results[task_id] = TaskCompleteResult(
+                id=task_id, ok=False, detail="Task not found"
+            )
+
+    completing = [task_id for task_id in task_ids if task_id in queuestep_ids]
+    parameters = [
+        {
+            "b_id": task_id,
+            "b_completed_data": pending_by_id[task_id].completed_data or {},
+        }
+        for task_id in completing
+    ]
+    complete = (
+        update(Task.__table__)
+        .where(Task.id == bindparam("b_id"), Task.completed == False)
+        .values(
+            completed=True,
+            completed_data=bindparam("b_completed_data"),
+            lease_expires_at=None,
+        )
+    )
+    if parameters:
+        updated = session.execute(complete, parameters)
+        if updated.rowcount < len(parameters):
+            # a concurrent request completed some of the tasks first; redo the updates one by
+            # one so that every task is only counted as completed once
+            session.rollback()
+            completing = [
+                task_id
+                for task_id, it in zip(completing, parameters)
+                if session.execute(complete, it).rowcount > 0
+            ]
+
+    completed_ids = set(completing)
+    num_completed_by_queuestep: Dict[int, Dict[int, int]] = {}
+    for task_id in task_ids:
+        if task_id in completed_ids:
+            results[task_id] = TaskCompleteResult(id=task_id, ok=True)
+            num_completed_by_user = num_completed_by_queuestep.setdefault(
+                queuestep_ids[task_id], {}
+            )
+            user_id = user_ids[task_id]
+            num_completed_by_user[user_id] = num_completed_by_user.get(user_id, 0) + 1
+        elif task_id not in results:
+            results[task_id] = TaskCompleteResult(
+                id=task_id, ok=False, detail="Task is already completed."
+            )
+    for queuestep_id, num_completed_by_user in num_completed_by_queuestep.items():
+        queuestep = session.get(QueueStep, queuestep_id)
+        if queuestep is not None:
+            queuestep.record_completions(num_completed_by_user)
+
+    return [results[completion.id] for completion in completions]
+
+
 class NextTask(BaseModel):
     """
     NextTask represents the metadata produced by the queue to specify a task to pass to the labeler.
@@ -185,6 +791,58 @@ class User(UserBase, table=True):
 
     tasks: List["Task"] = Relationship(back_populates="user")
 
+    def get_outstanding_task(self) -> Union[Task, None]:
+        """
+        The user's oldest incomplete task in any labelqueue, with current tasks ahead of
+        reservations.
+        """
+        return (
+            object_session(self)
+            .exec(
+                select(Task)
+                .where(Task.user_id == self.id, Task.completed == False)
+                .order_by(Task.reserved, Task.id)
+                .limit(1)
+            )
+            .first()
+        )
+
+    def get_active_queuesteps(self) -> List["QueueStep"]:
+        """
+        The active queuestep of every labelqueue the user belongs to, the one with the most
+        unassigned capacity first. The queuesteps are read with one query on the
+        (labelqueue_id, completed, rank) index and ranked by their counters, so the cost grows
+        with the number of labelqueues of the user and not with the number of tasks.
+        """
+        queuesteps = (
+            object_session(self)
+            .exec(
+                select(QueueStep)
+                .join(
+                    LabelQueueUserLink,
+                    LabelQueueUserLink.labelqueue_id == QueueStep.labelqueue_id,
+                )
+                .join(LabelQueue, LabelQueue.id == QueueStep.labelqueue_id)
+                .where(
+                    LabelQueueUserLink.user_id == self.id,
+                    LabelQueue.dataset_id != None,
+                    QueueStep.completed == False,
+                )
+                .order_by(QueueStep.labelqueue_id, QueueStep.rank)
+            )
+            .all()
+        )
+
+        active_queuesteps: Dict[int, QueueStep] = {}
+        for queuestep in queuesteps:
+            active_queuesteps.setdefault(queuestep.labelqueue_id, queuestep)
+
+        return sorted(
+            active_queuesteps.values(),
+            key=lambda queuestep: queuestep.num_records_assigned
+            - queuestep.get_capacity(),
+        )
+
 
 class UserCreate(UserBase):
     pass
@@ -210,18 +868,41 @@ class QueueType(enum.Enum):
 
 
 class PolicyArgsBase(BaseModel):
+    # quota on the tasks a single user is assigned in the queuestep
+    max_tasks_per_user: Optional[conint(gt=0)] = None
+
     class Config:
         validate_assignment = True
-        orm_mode = True
         extra = "forbid"
 
 
 class PolicyArgsDistribute(PolicyArgsBase):
     random: bool = False
+    # keys the pseudo-random frontier order; drawn once when a random queuestep is created
+    seed: Optional[int] = None
+
+    @validator("seed", always=True)
+    def draw_seed(cls, value, values):
+        if value is None and values.get("random"):
+            return random.getrandbits(63)
+        return value
 
 
 class PolicyArgsConsensus(PolicyArgsBase):
-    pass
+    # number of distinct users that label each record
+    num_labelers: conint(gt=0) = 2
+
+
+class PolicyArgsPriority(PolicyArgsBase):
+    # Record.data key holding the record's priority; higher priorities are assigned first
+    field: Optional[str] = None
+    # priority of records that do not have a numeric value for the field
+    default: float = 0
+
+
+class RecordPriority(BaseModel):
+    record_id: int
+    priority: float
 
 
 class QueueStepBase(SQLModel):
@@ -229,101 +910,665 @@ class QueueStepBase(SQLModel):
     description: Optional[str]
     num_records: Annotated[int, Field(gt=0)]
     type: QueueType = Field(sa_column=Column(Enum(QueueType)))
-    policy_args: Optional[Union[PolicyArgsDistribute, PolicyArgsConsensus]] = Field(
-        default=None, sa_column=Column(JSON)
-    )
+    policy_args: Optional[
+        Union[PolicyArgsDistribute, PolicyArgsConsensus, PolicyArgsPriority]
+    ] = Field(default=None, sa_column=Column(JSON))
 
     class Config:
         validate_assignment = True
 
 
 class QueueStep(QueueStepBase, table=True):
+    __table_args__ = (
+        UniqueConstraint("labelqueue_id", "rank"),
+        # serves the active queuestep lookup
+        Index(
+            "ix_queuestep_labelqueue_id_completed_rank",
+            "labelqueue_id",
+            "completed",
+            "rank",
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     labelqueue_id: int = Field(default=None, foreign_key="labelqueue.id", index=True)
+    # counters in units of tasks; the queuestep completes once all of its capacity is assigned
+    num_records_assigned: int = 0
     num_records_completed: int = 0
-    rank: int = Field(default=None, sa_column=Column("rank", Integer, unique=True))
+    # distinct records a consensus queuestep has started assigning, at most num_records
+    num_records_started: int = 0
+    rank: int = Field(default=None)
     completed: bool = False
 
     labelqueue: "LabelQueue" = Relationship(back_populates="queuesteps")
     tasks: List["Task"] = Relationship(back_populates="queuestep")
 
-    def get_next_task(self, user_id) -> NextTask:
+    def get_next_task(self, user_id) -> Union[NextTask, None]:
+        next_tasks = self.get_next_tasks(user_id, 1)
+
+        return next_tasks[0] if next_tasks else None
+
+    def get_next_tasks(self, user_id, num_tasks: int) -> List[NextTask]:
+        """
+        Get up to num_tasks next tasks for the user.
+        The user's quota and the queuestep capacity are reserved on their counters before the
+        frontier is claimed, so neither the user nor the queuestep are ever handed out more
+        tasks than they are allowed.
+        """
+        num_tasks = self._reserve_user_quota(user_id, num_tasks)
+        if num_tasks == 0:
+            return []
+
+        num_reserved = num_tasks
+        num_tasks = self._reserve_capacity(num_tasks)
+        if num_tasks < num_reserved:
+            self._release_user_quota(user_id, num_reserved - num_tasks)
+        if num_tasks == 0:
+            return []
+
         match self.type:
             case QueueType.distribute:
-                task = self._get_next_task_distribute()
+                next_tasks = self._get_next_tasks_distribute(num_tasks)
             case QueueType.consensus:
-                task = self._get_next_task_consensus(user_id)
+                next_tasks = self._get_next_tasks_consensus(user_id, num_tasks)
             case QueueType.priority:
-                task = self._get_next_task_priority(user_id)
+                next_tasks = self._get_next_tasks_priority(num_tasks)
             case _:
                 raise NotImplementedError(
                     f"The {self.type.name} queue policy has not been implemented."
                 )
 
-        return task
+        if len(next_tasks) < num_tasks:
+            self._release_capacity(num_tasks - len(next_tasks))
+            self._release_user_quota(user_id, num_tasks - len(next_tasks))
 
-    def _get_next_task_distribute(self) -> Union[NextTask, None]:
-        policy_args = PolicyArgsDistribute(**self.policy_args)
-        remaining_record_ids = self._get_remaining_records()
-        if len(remaining_record_ids) == 0:
-            return None
+        return next_tasks
 
-        # for the sequential policy, simply select the task with minimum id
-        # this does not take advantage of the table index
-        if policy_args.random:
-            record_id = random.choice(remaining_record_ids)
-        else:
-            record_id = min(remaining_record_ids)
+    def get_capacity(self) -> int:
+        """
+        The number of tasks the queuestep hands out: each of its records is assigned once, or
+        once per labeler for consensus.
+        """
+        return self.num_records * self._num_assignments()
+
+    def _reserve_capacity(self, num_tasks: int) -> int:
+        """
+        Reserve up to num_tasks assignments on the counters and return the number reserved.
+        The counter is advanced with a compare-and-set on the value that was read, so concurrent
+        claimers cannot overshoot the capacity. The queuestep completes when it is full, which
+        makes get_active_queuestep move on to the next queuestep.
+        """
+        session = object_session(self)
+        capacity = self.get_capacity()
+        while True:
+            num_assigned = session.exec(
+                select(QueueStep.num_records_assigned).where(QueueStep.id == self.id)
+            ).one()
+            num_tasks = min(num_tasks, capacity - num_assigned)
+            if num_tasks <= 0:
+                return 0
+
+            reserved = session.execute(
+                update(QueueStep.__table__)
+                .where(
+                    QueueStep.id == self.id,
+                    QueueStep.num_records_assigned == num_assigned,
+                )
+                .values(
+                    num_records_assigned=num_assigned + num_tasks,
+                    completed=num_assigned + num_tasks >= capacity,
+                )
+            )
+            if reserved.rowcount > 0:
+                session.expire(self, ["num_records_assigned", "completed"])
+                return num_tasks
 
-        return NextTask(
-            dataset_id=self.labelqueue.dataset_id,
-            record_id=record_id,
-            queuestep_id=self.id,
+    def _release_capacity(self, num_tasks: int):
+        """
+        Give back reserved or assigned capacity, reopening the queuestep if it was full.
+        """
+        session = object_session(self)
+        session.execute(
+            update(QueueStep.__table__)
+            .where(QueueStep.id == self.id)
+            .values(
+                num_records_assigned=QueueStep.num_records_assigned - num_tasks,
+                completed=False,
+            )
+        )
+        session.expire(self, ["num_records_assigned", "completed"])
+
+    def _reserve_user_quota(self, user_id, num_tasks: int) -> int:
+        """
+        Count up to num_tasks assignments on the user's counter and return the number counted.
+        With max_tasks_per_user the counter is advanced with a compare-and-set against the
+        quota, like the queuestep capacity.
+        """
+        session = object_session(self)
+        upsert = dialect_insert(session, QueueStepUserStats.__table__).values(
+            queuestep_id=self.id, user_id=user_id, num_assigned=num_tasks
+        )
+        max_tasks_per_user = self._max_tasks_per_user()
+        if max_tasks_per_user is None:
+            # without a quota the counter is advanced in a single statement
+            session.execute(
+                upsert.on_conflict_do_update(
+                    index_elements=["queuestep_id", "user_id"],
+                    set_={"num_assigned": QueueStepUserStats.num_assigned + num_tasks},
+                )
+            )
+            return num_tasks
+
+        session.execute(upsert.values(num_assigned=0).on_conflict_do_nothing())
+        user_stats = (
+            QueueStepUserStats.queuestep_id == self.id,
+            QueueStepUserStats.user_id == user_id,
+        )
+        while True:
+            num_assigned = session.exec(
+                select(QueueStepUserStats.num_assigned).where(*user_stats)
+            ).one()
+            num_tasks = min(num_tasks, max_tasks_per_user - num_assigned)
+            if num_tasks <= 0:
+                return 0
+
+            reserved = session.execute(
+                update(QueueStepUserStats.__table__)
+                .where(*user_stats, QueueStepUserStats.num_assigned == num_assigned)
+                .values(num_assigned=num_assigned + num_tasks)
+            )
+            if reserved.rowcount > 0:
+                return num_tasks
+
+    def _release_user_quota(self, user_id, num_tasks: int):
+        object_session(self).execute(
+            update(QueueStepUserStats.__table__)
+            .where(
+                QueueStepUserStats.queuestep_id == self.id,
+                QueueStepUserStats.user_id == user_id,
+            )
+            .values(num_assigned=QueueStepUserStats.num_assigned - num_tasks)
         )
 
-    def _get_next_task_consensus(self, user_id) -> Union[NextTask, None]:
-        raise NotImplementedError("_get_next_task_consensus has not been implemented")
+    def record_completions(self, num_completed_by_user: Dict[int, int]):
+        """
+        Count newly completed tasks of the queuestep, given per user.
+        """
+        session = object_session(self)
+        session.execute(
+            update(QueueStep.__table__)
+            .where(QueueStep.id == self.id)
+            .values(
+                num_records_completed=QueueStep.num_records_completed
+                + sum(num_completed_by_user.values())
+            )
+        )
+        session.execute(
+            update(QueueStepUserStats.__table__)
+            .where(
+                QueueStepUserStats.queuestep_id == self.id,
+                QueueStepUserStats.user_id == bindparam("b_user_id"),
+            )
+            .values(
+                num_completed=QueueStepUserStats.num_completed
+                + bindparam("b_num_completed")
+            ),
+            [
+                {"b_user_id": user_id, "b_num_completed": num_completed}
+                for user_id, num_completed in num_completed_by_user.items()
+            ],
+        )
+        session.expire(self, ["num_records_completed"])
 
-    def _get_next_task_priority(self, user_id) -> Union[NextTask, None]:
-        raise NotImplementedError("_get_next_task_priority has not been implemented")
+    def _get_next_tasks_distribute(self, num_tasks: int) -> List[NextTask]:
+        # the frontier position is either the record id (sequential) or a keyed permutation of
+        # it (random), so both policies simply walk the frontier in position order
+        return [
+            NextTask(
+                dataset_id=self.labelqueue.dataset_id,
+                record_id=record_id,
+                queuestep_id=self.id,
+            )
+            for record_id in self._pop_frontier(num_tasks)
+        ]
 
-    def _get_remaining_records(self):
-        assigned_record_ids = {task.record.id for task in self.labelqueue.tasks}
+    def _get_next_tasks_consensus(self, user_id, num_tasks: int) -> List[NextTask]:
+        # records with the fewest assignments come first, skipping records the user already has
+        return [
+            NextTask(
+                dataset_id=self.labelqueue.dataset_id,
+                record_id=record_id,
+                queuestep_id=self.id,
+            )
+            for record_id in self._claim_consensus(user_id, num_tasks)
+        ]
 
+    def _get_next_tasks_priority(self, num_tasks: int) -> List[NextTask]:
+        # the frontier is ordered by descending priority, so the highest priorities come first
         return [
-            record.id
-            for record in self.labelqueue.dataset.records
-            if record.id not in assigned_record_ids
+            NextTask(
+                dataset_id=self.labelqueue.dataset_id,
+                record_id=record_id,
+                queuestep_id=self.id,
+            )
+            for record_id in self._pop_frontier(num_tasks)
         ]
 
+    def _select_remaining_records(self):
+        """
+        Select the ids of dataset records that have not yet been assigned in this labelqueue.
+        The anti-join is resolved against the (labelqueue_id, record_id) task index so that
+        records never have to be loaded into python.
+        """
+        assigned = exists().where(
+            Task.labelqueue_id == self.labelqueue_id, Task.record_id == Record.id
+        )
+
+        return select(Record.id).where(
+            Record.dataset_id == self.labelqueue.dataset_id, ~assigned
+        )
+
+    def seed_frontier(self, *criteria):
+        """
+        Add remaining records that are not yet on this queuestep's frontier.
+        Optional criteria restrict the records considered, e.g. `Record.id > last_id` when
+        records are appended to the dataset.
+        """
+        if self.labelqueue.dataset_id is None:
+            return
+
+        seeded = exists().where(
+            FrontierRecord.queuestep_id == self.id,
+            FrontierRecord.record_id == Record.id,
+        )
+        remaining_records = self._select_remaining_records().where(~seeded, *criteria)
+
+        seed = self._frontier_seed()
+        priority_args = self._priority_args()
+        if seed is None and (priority_args is None or priority_args.field is None):
+            object_session(self).execute(
+                insert(FrontierRecord).from_select(
+                    [
+                        "queuestep_id",
+                        "record_id",
+                        "labelqueue_id",
+                        "position",
+                        "priority",
+                    ],
+                    remaining_records.with_only_columns(
+                        literal(self.id),
+                        Record.id,
+                        literal(self.labelqueue_id),
+                        Record.id,
+                        literal(priority_args.default if priority_args else 0.0),
+                    ),
+                )
+            )
+        else:
+            self._seed_frontier_chunked(remaining_records, seed, priority_args)
+
+    def rebuild_frontier(self):
+        """
+        Reseed the frontier after the queuestep's policy changed, so that the remaining records
+        take the order of the new policy. Records a consensus step has already started keep
+        their rows and assignment counts, and the started records are recounted.
+        """
+        session = object_session(self)
+        session.execute(
+            delete(FrontierRecord).where(
+                FrontierRecord.queuestep_id == self.id,
+                FrontierRecord.num_assigned == 0,
+            )
+        )
+        self.seed_frontier()
+
+        session.execute(
+            update(QueueStep.__table__)
+            .where(QueueStep.id == self.id)
+            .values(
+                num_records_started=select(func.count(func.distinct(Task.record_id)))
+                .where(Task.queuestep_id == self.id)
+                .scalar_subquery()
+            )
+        )
+        session.expire(self, ["num_records_started"])
+
+    def release_records(self, record_ids: List[int], user_ids: List[int] = ()):
+        """
+        Return records to the frontier after some of their tasks in this queuestep were deleted.
+        Consensus steps recount the records' remaining assignments; every other queuestep in the
+        labelqueue gets a record back once none of its tasks remain. The released tasks' capacity
+        is given back to the queuestep, and the assignment counters of the users whose tasks
+        were deleted are recounted.
+        """
+        if self.type == QueueType.consensus:
+            session = object_session(self)
+            session.execute(
+                delete(FrontierRecord).where(
+                    FrontierRecord.queuestep_id == self.id,
+                    FrontierRecord.record_id.in_(record_ids),
+                )
+            )
+            num_assigned = session.execute(
+                select(Task.record_id, func.count(Task.id))
+                .where(
+                    Task.labelqueue_id == self.labelqueue_id,
+                    Task.record_id.in_(record_ids),
+                    Task.queuestep_id == self.id,
+                )
+                .group_by(Task.record_id)
+            ).all()
+            partially_assigned = [
+                dict(
+                    queuestep_id=self.id,
+                    record_id=record_id,
+                    labelqueue_id=self.labelqueue_id,
+                    position=record_id,
+                    num_assigned=count,
+                )
+                for record_id, count in num_assigned
+                if count < self._num_assignments()
+            ]
+            if partially_assigned:
+                session.execute(insert(FrontierRecord), partially_assigned)
+            # records without any remaining task no longer count as started
+            num_unstarted = len(set(record_ids)) - len(num_assigned)
+            if num_unstarted > 0:
+                self._unstart_records(num_unstarted)
+
+        self.labelqueue.seed_frontier(Record.id.in_(record_ids))
+        self._release_capacity(len(record_ids))
+        if user_ids:
+            self._recount_user_stats(user_ids)
+
+    def _recount_user_stats(self, user_ids: List[int]):
+        # the count is an aggregate on the (queuestep_id, user_id, record_id) task index
+        num_assigned = (
+            select(func.count(Task.id))
+            .where(
+                Task.queuestep_id == QueueStepUserStats.queuestep_id,
+                Task.user_id == QueueStepUserStats.user_id,
+            )
+            .scalar_subquery()
+        )
+        object_session(self).execute(
+            update(QueueStepUserStats.__table__)
+            .where(
+                QueueStepUserStats.queuestep_id == self.id,
+                QueueStepUserStats.user_id.in_(list(user_ids)),
+            )
+            .values(num_assigned=num_assigned)
+        )
+
+    def _num_assignments(self) -> int:
+        """
+        The number of times each record is assigned by this queuestep.
+        """
+        if self.type == QueueType.consensus:
+            return PolicyArgsConsensus(**self.policy_args).num_labelers
+
+        return 1
+
+    def _max_tasks_per_user(self) -> Union[int, None]:
+        """
+        The quota on the tasks a single user is assigned, or None if users are not capped.
+        """
+        return (self.policy_args or {}).get("max_tasks_per_user")
+
+    def _frontier_seed(self) -> Union[int, None]:
+        """
+        The seed of the pseudo-random frontier order, or None if records are taken in id order.
+        """
+        if self.type == QueueType.distribute:
+            policy_args = PolicyArgsDistribute(**self.policy_args)
+            if policy_args.random:
+                return policy_args.seed
+
+        return None
+
+    def _priority_args(self) -> Union[PolicyArgsPriority, None]:
+        """
+        The priority policy arguments, or None if the queuestep does not use priorities.
+        """
+        if self.type == QueueType.priority:
+            return PolicyArgsPriority(**self.policy_args)
+
+        return None
+
+    def _seed_frontier_chunked(
+        self,
+        remaining_records,
+        seed: Union[int, None],
+        priority_args: Union[PolicyArgsPriority, None],
+        chunk_size=10000,
+    ):
+        """
+        Seed the frontier with values that are computed in python.
+        With a seed, positions are drawn from a keyed permutation of the record ids. Positions
+        only depend on the seed and the record id, so the assignment order is reproducible and
+        can be replayed from the seed alone.
+        With a priority field, priorities are read from the record data.
+        Records are read in keyset-paginated chunks to keep memory bounded.
+        """
+        session = object_session(self)
+        last_record_id = 0
+        while True:
+            records = session.execute(
+                remaining_records.with_only_columns(Record.id, Record.data)
+                .where(Record.id > last_record_id)
+                .order_by(Record.id)
+                .limit(chunk_size)
+            ).all()
+            if not records:
+                break
+
+            session.execute(
+                insert(FrontierRecord),
+                [
+                    dict(
+                        queuestep_id=self.id,
+                        record_id=record_id,
+                        labelqueue_id=self.labelqueue_id,
+                        position=(
+                            record_id
+                            if seed is None
+                            else permutation_position(seed, record_id)
+                        ),
+                        priority=(
+                            0
+                            if priority_args is None
+                            else record_priority(priority_args, data)
+                        ),
+                    )
+                    for record_id, data in records
+                ],
+            )
+            last_record_id = records[-1][0]
+
+    def _pop_frontier(self, num_records: int = 1) -> List[int]:
+        """
+        Claim up to num_records records from the head of the frontier.
+        The record is removed from the frontier of every queuestep in the labelqueue because
+        a record is only assigned once per labelqueue.
+
+        The delete is the claim: a concurrent request that read the same head of the frontier
+        deletes no rows and retries with the next record. On SQLite the first delete also takes
+        the database write lock, so the retry reads a frontier that can no longer change under
+        it. On Postgres the head is read with SKIP LOCKED so concurrent claimers rarely collide.
+        """
+        session = object_session(self)
+        record_ids = []
+        while len(record_ids) < num_records:
+            candidate_ids = session.exec(
+                select(FrontierRecord.record_id)
+                .where(FrontierRecord.queuestep_id == self.id)
+                .order_by(*FRONTIER_ORDER)
+                .limit(num_records - len(record_ids))
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not candidate_ids:
+                break
+
+            for record_id in candidate_ids:
+                claimed = session.execute(
+                    delete(FrontierRecord).where(
+                        FrontierRecord.labelqueue_id == self.labelqueue_id,
+                        FrontierRecord.record_id == record_id,
+                    )
+                )
+                if claimed.rowcount > 0:
+                    record_ids.append(record_id)
+
+        return record_ids
+
+    def _claim_consensus(self, user_id, num_records: int) -> List[int]:
+        """
+        Claim up to num_records records for the user from a consensus frontier.
+        Each claim increments the record's assignment count, guarded on the count still being
+        below the number of labelers, so concurrent claimers cannot over-assign a record.
+        Records that reach the number of labelers leave the frontier. Only num_records distinct
+        records are started, so that the capacity is spent on records reaching consensus
+        rather than on more records with a single label each.
+        """
+        session = object_session(self)
+        num_labelers = self._num_assignments()
+        labeled_by_user = exists().where(
+            Task.queuestep_id == self.id,
+            Task.user_id == user_id,
+            Task.record_id == FrontierRecord.record_id,
+        )
+
+        record_ids = []
+        can_start = self.num_records_started < self.num_records
+        while len(record_ids) < num_records:
+            candidates = select(FrontierRecord.record_id, FrontierRecord.num_assigned)
+            if not can_start:
+                candidates = candidates.where(FrontierRecord.num_assigned > 0)
+            candidates = session.execute(
+                candidates.where(
+                    FrontierRecord.queuestep_id == self.id, ~labeled_by_user
+                )
+                .where(FrontierRecord.record_id.not_in(record_ids))
+                .order_by(*FRONTIER_ORDER)
+                .limit(num_records - len(record_ids))
+            ).all()
+            if not candidates:
+                break
+
+            for record_id, num_assigned in candidates:
+                if num_assigned == 0:
+                    if not can_start:
+                        continue
+                    can_start = self._start_record()
+                    if not can_start:
+                        continue
+
+                step_record = (
+                    FrontierRecord.queuestep_id == self.id,
+                    FrontierRecord.record_id == record_id,
+                )
+                claimed = session.execute(
+                    update(FrontierRecord)
+                    .where(
+                        *step_record,
+                        FrontierRecord.num_assigned == num_assigned,
+                        FrontierRecord.num_assigned < num_labelers,
+                    )
+                    .values(num_assigned=FrontierRecord.num_assigned + 1)
+                )
+                if claimed.rowcount == 0:
+                    if num_assigned == 0:
+                        self._unstart_records(1)
+                    continue
+
+                record_ids.append(record_id)
+                session.execute(
+                    delete(FrontierRecord).where(
+                        *step_record, FrontierRecord.num_assigned >= num_labelers
+                    )
+                )
+                # the record now belongs to this queuestep
+                session.execute(
+                    delete(FrontierRecord).where(
+                        FrontierRecord.labelqueue_id == self.labelqueue_id,
+                        FrontierRecord.record_id == record_id,
+                        FrontierRecord.queuestep_id != self.id,
+                    )
+                )
+
+        return record_ids
+
+    def _start_record(self) -> bool:
+        """
+        Count a newly started record, unless num_records records have already been started.
+        """
+        session = object_session(self)
+        started = session.execute(
+            update(QueueStep.__table__)
+            .where(
+                QueueStep.id == self.id,
+                QueueStep.num_records_started < QueueStep.num_records,
+            )
+            .values(num_records_started=QueueStep.num_records_started + 1)
+        )
+        session.expire(self, ["num_records_started"])
+
+        return started.rowcount > 0
+
+    def _unstart_records(self, num_records: int):
+        session = object_session(self)
+        session.execute(
+            update(QueueStep.__table__)
+            .where(QueueStep.id == self.id)
+            .values(num_records_started=QueueStep.num_records_started - num_records)
+        )
+        session.expire(self, ["num_records_started"])
+
+    @classmethod
+    def parse_policy_args(cls, queue_type: QueueType, value) -> dict:
+        """
+        Validate policy_args data using the model associated with the policy type and return
+        it as a plain dict that can be stored in the JSON column. A missing policy arguments
+        object gives the policy's defaults. Raises ValidationError if the arguments do not fit
+        the policy.
+        """
+        match queue_type:
+            case QueueType.distribute:
+                policy_args_model = PolicyArgsDistribute
+            case QueueType.consensus:
+                policy_args_model = PolicyArgsConsensus
+            case QueueType.priority:
+                policy_args_model = PolicyArgsPriority
+            case _:
+                raise NotImplementedError(
+                    f"PolicyArgs has not been implemented for queue type '{queue_type}'."
+                )
+
+        # the union field may have parsed the arguments with another policy's model, so only
+        # the explicitly provided arguments are carried over
+        if isinstance(value, BaseModel):
+            value = value.dict(exclude_unset=True)
+
+        return policy_args_model.parse_obj(value or {}).dict()
+
     @validator("policy_args")
     def check_policy_args_by_type(cls, value, values):
         """
         Validate the provided policy_args data using the model associated with the policy type.
         This is needed because different policy types have different argument structures that need
         separate validation logic.
-
-        If no policy arguments object is passed, instantiate the default.
         """
         queue_type = values.get("type")
 
         if queue_type:
-            match queue_type:
-                case QueueType.distribute:
-                    return (
-                        PolicyArgsDistribute.from_orm(value)
-                        if value
-                        else PolicyArgsDistribute()
-                    )
-                case _:
-                    raise NotImplementedError(
-                        f"PolicyArgs has not been implemented for queue type '{queue_type}'."
-                    )
+            return cls.parse_policy_args(queue_type, value)
 
 
 class QueueStepRead(QueueStepBase):
     id: int
+    num_records_assigned: int
     num_records_completed: int
+    num_records_started: int
     rank: int
     completed: bool
 
@@ -344,6 +1589,8 @@ class QueueStepUpdate(QueueStepBase):
 class LabelQueueBase(SQLModel):
     name: str
     description: Optional[str]
+    # seconds a task stays assigned without a heartbeat; tasks never expire if not set
+    lease_duration: Optional[Annotated[int, Field(gt=0)]] = None
 
     class Config:
         validate_assignment = True
@@ -366,24 +1613,195 @@ class LabelQueue(LabelQueueBase, table=True):
     def get_active_queuestep(self) -> Union[QueueStep, None]:
         """
         The active questep is the queuestep with lowest rank that is not completed.
+        It is a single LIMIT 1 query on the (labelqueue_id, completed, rank) index.
         """
-        incomplete_queuesteps: List[QueueStep] = list(
-            filter(lambda x: not x.completed, self.queuesteps)
+        return (
+            object_session(self)
+            .exec(
+                select(QueueStep)
+                .where(QueueStep.labelqueue_id == self.id, QueueStep.completed == False)
+                .order_by(QueueStep.rank)
+                .limit(1)
+            )
+            .first()
         )
 
-        if len(incomplete_queuesteps) < 1:
-            return None
-        else:
-            return min(incomplete_queuesteps, key=lambda x: x.rank)
+    def seed_frontier(self, *criteria):
+        """
+        Seed the frontier of every queuestep in the labelqueue.
+        """
+        for queuestep in self.queuesteps:
+            queuestep.seed_frontier(*criteria)
+
+    def clear_frontier(self):
+        """
+        Remove every frontier record of the labelqueue, e.g. when its dataset is unregistered.
+        """
+        object_session(self).execute(
+            delete(FrontierRecord).where(FrontierRecord.labelqueue_id == self.id)
+        )
 
-    def get_next_task(self, user_id) -> NextTask:
+    def get_next_task(self, user_id, queuestep: QueueStep = None) -> NextTask:
         """
         Get a qualifying next task for the user using the queuestep policy.
+        The active queuestep is looked up unless the caller already resolved it.
         """
+        next_tasks = self.get_next_tasks(user_id, 1, queuestep)
 
-        active_queuestep = self.get_active_queuestep()
+        return next_tasks[0] if next_tasks else None
 
-        return active_queuestep.get_next_task(user_id)
+    def get_lease_expiry(self) -> Union[datetime, None]:
+        """
+        Expiry of a lease taken or renewed now, or None if the labelqueue does not use leases.
+        """
+        if self.lease_duration is None:
+            return None
+
+        return datetime.utcnow() + timedelta(seconds=self.lease_duration)
+
+    def get_reservation_expiry(self) -> datetime:
+        """
+        Expiry of a reservation taken now. Reservations use the labelqueue's lease duration, or
+        RESERVATION_DURATION if the labelqueue does not use leases.
+        """
+        return datetime.utcnow() + timedelta(
+            seconds=self.lease_duration or RESERVATION_DURATION
+        )
+
+    def get_next_tasks(
+        self, user_id, num_tasks: int, queuestep: QueueStep = None
+    ) -> List[NextTask]:
+        """
+        Get up to num_tasks qualifying next tasks for the user using the queuestep policy.
+        """
+        active_queuestep = queuestep or self.get_active_queuestep()
+        if active_queuestep is None:
+            return []
+
+        return active_queuestep.get_next_tasks(user_id, num_tasks)
+
+    def get_outstanding_task(
+        self, user_id, idempotency_key: str = None
+    ) -> Union[Task, None]:
+        """
+        The task a task request should return instead of claiming a new record: the task
+        created with the idempotency key if one is given and matches, otherwise the user's
+        oldest incomplete task in the labelqueue, with the current task ahead of reservations.
+        """
+        session = object_session(self)
+        user_tasks = select(Task).where(
+            Task.labelqueue_id == self.id, Task.user_id == user_id
+        )
+        if idempotency_key is not None:
+            task = session.exec(
+                user_tasks.where(Task.idempotency_key == idempotency_key).limit(1)
+            ).first()
+            if task is not None:
+                return task
+
+        return session.exec(
+            user_tasks.where(Task.completed == False)
+            .order_by(Task.reserved, Task.id)
+            .limit(1)
+        ).first()
+
+    def get_outstanding_tasks(self, user_id, num_tasks: int) -> List[Task]:
+        """
+        The user's oldest incomplete tasks in the labelqueue.
+        """
+        return (
+            object_session(self)
+            .exec(
+                select(Task)
+                .where(
+                    Task.labelqueue_id == self.id,
+                    Task.user_id == user_id,
+                    Task.completed == False,
+                )
+                .order_by(Task.id)
+                .limit(num_tasks)
+            )
+            .all()
+        )
+
+    def activate_task(self, task: Task, idempotency_key: str = None):
+        """
+        Hand out a task as the user's current task. An incomplete task gets a fresh lease, so
+        that it is not swept while the user works on it, and a reserved task loses its
+        reservation. A task without an idempotency key takes the request's key, so that a
+        retry of the request returns the same task.
+        """
+        if task.completed:
+            return
+
+        task.reserved = False
+        task.lease_expires_at = self.get_lease_expiry()
+        if task.idempotency_key is None:
+            task.idempotency_key = idempotency_key
+
+    def reserve_tasks(
+        self, user_id, num_tasks: int, queuestep: QueueStep = None
+    ) -> List[Task]:
+        """
+        Soft-reserve the next num_tasks records for the user. The user's existing reservations
+        are reused and topped up with new claims. Reservations that are never handed out are
+        released with the expired leases.
+        """
+        tasks = (
+            object_session(self)
+            .exec(
+                select(Task)
+                .where(
+                    Task.labelqueue_id == self.id,
+                    Task.user_id == user_id,
+                    Task.completed == False,
+                    Task.reserved == True,
+                )
+                .order_by(Task.id)
+                .limit(num_tasks)
+            )
+            .all()
+        )
+
+        if len(tasks) < num_tasks and queuestep is not None:
+            reservation_expires_at = self.get_reservation_expiry()
+            for task in self.create_tasks(user_id, num_tasks - len(tasks), queuestep):
+                task.reserved = True
+                task.lease_expires_at = reservation_expires_at
+                tasks.append(task)
+
+        return tasks
+
+    def create_task(self, user_id, queuestep: QueueStep = None) -> Union[Task, None]:
+        """
+        Claim the next task for the user and add it to the session.
+        Returns None if the queue is empty. The claim is only final once the session commits.
+        """
+        tasks = self.create_tasks(user_id, 1, queuestep)
+
+        return tasks[0] if tasks else None
+
+    def create_tasks(
+        self, user_id, num_tasks: int, queuestep: QueueStep = None
+    ) -> List[Task]:
+        """
+        Claim up to num_tasks next tasks for the user and add them to the session.
+        """
+        lease_expires_at = self.get_lease_expiry()
+        tasks = [
+            Task(
+                record_id=next_task.record_id,
+                dataset_id=next_task.dataset_id,
+                user_id=user_id,
+                queuestep_id=next_task.queuestep_id,
+                labelqueue_id=self.id,
+                lease_expires_at=lease_expires_at,
+            )
+            for next_task in self.get_next_tasks(user_id, num_tasks, queuestep)
+        ]
+        object_session(self).add_all(tasks)
+
+        return tasks
 
 
 class LabelQueueCreate(LabelQueueBase):
@@ -423,6 +1841,14 @@ class TaskReadWithRelations(TaskRead):
     queuestep: QueueStep
 
 
+class TaskReadWithRecord(TaskRead):
+    record: Record
+
+
+class TaskReadWithReservations(TaskReadWithRelations):
+    reservations: List[TaskReadWithRecord] = []
+
+
 class DatasetReadWithRelations(DatasetRead):
     records: List["RecordRead"]
     labelqueues: List["LabelQueue"]
@@ -1,9 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, SQLModel, create_engine, select
 from sqlmodel.pool import StaticPool
 
+from blobs import BlobStore
+from compression import migrate_column
+from importer import import_records, iter_record_chunks
 from main import app, get_session
+import database
+import main
 from models import *
 
 client = TestClient(app)
@@ -87,3 +102,1113 @@ def test_create_records(client: TestClient):
     dataset = DatasetReadWithRelations(**response.json())
     assert len(dataset.records) == len(db_records)
     assert dataset.records[2].data["text"] == db_records[2]["data"]["text"]
+
+
+#
+# Tasks
+#
+user_json = {"name": "Test User", "email": "test.user@example.com", "role": "Labeler"}
+labelqueue_json = {
+    "name": "Test LabelQueue",
+    "description": "A labelqueue for testing.",
+}
+queuestep_json = {
+    "name": "Test QueueStep",
+    "num_records": 4,
+    "type": "distribute",
+}
+
+
+def setup_labelqueue(client: TestClient, queuestep=queuestep_json):
+    client.post("/datasets/", json=db_json)
+    client.post("/dataset/1/records", json=db_records)
+    client.post("/users/", json=user_json)
+    client.post("/labelqueues/", json=labelqueue_json)
+    client.post("/datasets/1/labelqueues/1")
+    client.post("/labelqueues/1/users/1")
+    client.post("/labelqueues/1/queue_step/", json=queuestep)
+
+
+def claim_task(client: TestClient, user_id: int = 1):
+    # the user's next task is only assigned once the outstanding one is completed
+    response = client.post(f"/labelqueues/1/{user_id}/task/")
+    if response.status_code == 200:
+        client.patch(f"/tasks/{response.json()['id']}", json={"completed_data": {}})
+    return response
+
+
+def test_create_records_bulk(client: TestClient):
+    setup_labelqueue(client)
+
+    response = client.post("/dataset/1/records/", json=db_records)
+    assert response.json() == {
+        "ok": True,
+        "num_records": 4,
+        "first_record_id": 5,
+        "last_record_id": 8,
+        "num_duplicates": 0,
+    }
+
+    response = client.post("/dataset/1/records/bulk", json=db_records[:2])
+    assert response.json()["first_record_id"] == 9
+    response = client.post(
+        "/dataset/1/records/bulk", json=db_records, params={"validate": False}
+    )
+    assert response.json()["last_record_id"] == 14
+    assert client.get("/queuesteps/1/frontier", params={"limit": 20}).json() == list(
+        range(1, 15)
+    )
+
+    response = client.post("/dataset/1/records/bulk", json=[{"data": {}}, {"data": 1}])
+    assert response.status_code == 422
+    assert "Record 1" in response.json()["detail"]
+
+
+def test_create_records_dedupe(client: TestClient):
+    setup_labelqueue(client)
+
+    # records added before dedupe is turned on are hashed, apart from duplicates among them
+    client.post("/dataset/1/records/", json=db_records[:1])
+    client.patch("/datasets/1", json={"dedupe": True})
+
+    records = [{"data": {"b": 1, "a": [1, 2]}}, {"data": {"a": [1, 2], "b": 1}}]
+    response = client.post("/dataset/1/records/", json=db_records + records)
+    assert response.json() == {
+        "ok": True,
+        "num_records": 1,
+        "first_record_id": 6,
+        "last_record_id": 6,
+        "num_duplicates": 5,
+    }
+    response = client.post("/dataset/1/records/bulk", json=records)
+    assert response.json()["num_duplicates"] == 2
+    assert len(client.get("/datasets/1").json()["records"]) == len(db_records) + 2
+
+
+def test_update_record_dedupe(client: TestClient):
+    client.post("/datasets/", json={**db_json, "dedupe": True})
+    client.post("/dataset/1/records/", json=db_records[:2])
+
+    # an updated record is hashed again, so its new data counts as a duplicate of it
+    response = client.patch("/records/1", json={"data": {"text": "A new text"}})
+    assert response.status_code == 200
+    response = client.post(
+        "/dataset/1/records/", json=[{"data": {"text": "A new text"}}]
+    )
+    assert response.json()["num_duplicates"] == 1
+    response = client.post("/dataset/1/records/", json=db_records[:1])
+    assert response.json()["num_records"] == 1
+
+    response = client.patch("/records/1", json={"data": db_records[1]["data"]})
+    assert response.status_code == 406
+    assert client.get("/records/1").json()["data"] == {"text": "A new text"}
+    assert client.patch("/records/10", json={"data": {}}).status_code == 404
+
+
+def test_record_blobs(client: TestClient, monkeypatch, tmp_path):
+    monkeypatch.setattr(Record, "blob_store", BlobStore(str(tmp_path), min_size=100))
+    setup_labelqueue(client)
+
+    text = "large payload " * 100
+    client.post("/dataset/1/records/", json=[{"data": {"text": text, "label": "x"}}])
+    data = client.get(f"/records/{len(db_records) + 1}").json()["data"]
+    digest = data["text"]["$blob"]
+    assert data["label"] == "x"
+    assert (tmp_path / digest[:2] / digest[2:4] / digest).read_text() == text
+
+    # references are resolved on request or streamed from the blob endpoint
+    response = client.get(
+        f"/records/{len(db_records) + 1}", params={"resolve_blobs": True}
+    )
+    assert response.json()["data"] == {"text": text, "label": "x"}
+    assert client.get(f"/blobs/{digest}").text == text
+    assert client.get(f"/blobs/{'0' * 64}").status_code == 404
+    assert client.get("/blobs/not-a-digest").status_code == 422
+
+    # user data that only looks like a reference is returned as it is
+    data = {"text": {"$blob": "not-a-digest"}, "count": {"$blob": 1}}
+    client.post("/dataset/1/records/", json=[{"data": data}])
+    response = client.get(
+        f"/records/{len(db_records) + 2}", params={"resolve_blobs": True}
+    )
+    assert response.status_code == 200
+    assert response.json()["data"] == data
+
+
+def test_compressed_json_migration(session: Session):
+    dataset = Dataset(name="notes")
+    session.add(dataset)
+    session.commit()
+    note = {"text": "patient reports no change. " * 20}
+    session.execute(
+        text("INSERT INTO record (dataset_id, data) VALUES (:dataset_id, :data)"),
+        {"dataset_id": dataset.id, "data": json.dumps(note)},
+    )
+    session.commit()
+
+    # rows written as JSON text before the migration stay readable
+    assert session.exec(select(Record.data)).one() == note
+    session.commit()
+
+    with session.get_bind().connect() as connection:
+        assert migrate_column(connection, Record.__table__, "data") == 1
+    content = session.execute(text("SELECT data FROM record")).scalar_one()
+    assert isinstance(content, bytes) and len(content) < len(json.dumps(note)) / 5
+    assert session.exec(select(Record.data)).one() == note
+
+
+def test_stream_records(client: TestClient, monkeypatch):
+    monkeypatch.setattr(main, "INGEST_CHUNK_SIZE", 3)
+    setup_labelqueue(client)
+
+    body = "\n".join(json.dumps({"data": {"i": i}}) for i in range(7)) + "\n"
+    response = client.post("/dataset/1/records/ndjson", content=body)
+    assert response.json() == {"ok": True, "num_records": 7}
+    assert len(client.get("/datasets/1").json()["records"]) == len(db_records) + 7
+
+    # ingested records are seeded into the frontier
+    frontier = client.get("/queuesteps/1/frontier", params={"limit": 20}).json()
+    assert frontier == list(range(1, len(db_records) + 8))
+
+    # chunks before an invalid line stay ingested
+    body = '{"data": {"i": 0}}\n' * 3 + '{"data": 1}\n'
+    response = client.post("/dataset/1/records/ndjson", content=body)
+    assert response.status_code == 422
+    assert "line 4" in response.json()["detail"]
+    assert len(client.get("/datasets/1").json()["records"]) == len(db_records) + 10
+
+
+def wait_for_ingest_job(client: TestClient, job_id: int):
+    for _ in range(100):
+        job = client.get(f"/ingestjobs/{job_id}").json()
+        if job["status"] not in ("Pending", "Running"):
+            return job
+        time.sleep(0.05)
+
+
+def test_ingest_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "INGEST_CHUNK_SIZE", 3)
+    monkeypatch.setattr(main, "INGEST_SPOOL_DIR", str(tmp_path))
+
+    # the job runs in a worker thread, so every request gets its own session
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'ingest.db'}",
+        connect_args={"check_same_thread": False},
+        poolclass=NullPool,
+    )
+    SQLModel.metadata.create_all(engine)
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_session_override
+    try:
+        client = TestClient(app)
+        client.post("/datasets/", json=db_json)
+
+        lines = [json.dumps({"data": {"i": i}}) for i in range(7)]
+        lines.insert(4, "not json")
+        response = client.post("/dataset/1/records/jobs", content="\n".join(lines))
+        assert response.status_code == 200
+        job = wait_for_ingest_job(client, response.json()["id"])
+
+        assert job["status"] == "Completed"
+        assert (job["num_lines"], job["num_records"], job["num_errors"]) == (8, 7, 1)
+        assert job["errors"][0]["line"] == 5
+        assert job["records_per_second"] > 0
+        assert len(client.get("/datasets/1").json()["records"]) == 7
+        assert list(tmp_path.glob("*.ndjson")) == []
+
+        # csv columns become the fields of each record's data; rows with more fields than
+        # the header are reported as errors
+        body = "name,label\n" + "".join(f"record {i},{i % 2}\n" for i in range(5))
+        response = client.post(
+            "/dataset/1/records/jobs",
+            content=body + "record 5,1,extra\n",
+            params={"format": "csv"},
+        )
+        job = wait_for_ingest_job(client, response.json()["id"])
+
+        assert (job["status"], job["num_lines"], job["num_records"]) == (
+            "Completed",
+            6,
+            5,
+        )
+        assert job["errors"] == [
+            {"line": 6, "detail": "The row has more fields than the header."}
+        ]
+        records = client.get("/datasets/1").json()["records"]
+        assert records[-1]["data"] == {"name": "record 4", "label": "0"}
+
+        monkeypatch.setattr(main, "pq", None)
+        response = client.post(
+            "/dataset/1/records/jobs", content=b"", params={"format": "parquet"}
+        )
+        assert response.status_code == 406
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_import_records_parquet(session: Session, tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    path = str(tmp_path / "records.parquet")
+    table = pa.table({"text": [f"record {i}" for i in range(5)], "score": range(5)})
+    pq.write_table(table, path, row_group_size=2)
+
+    dataset = Dataset(name="dataset")
+    session.add(dataset)
+    session.commit()
+    assert import_records(session, dataset, path, RecordFormat.parquet, 3) == 5
+    records = session.exec(select(Record).order_by(Record.id)).all()
+    assert records[-1].data == {"text": "record 4", "score": 4}
+
+    # an interrupted import resumes inside a row group
+    chunks = list(iter_record_chunks(path, RecordFormat.parquet, 2, skip=3))
+    assert [(num_rows, len(records)) for num_rows, records, _ in chunks] == [
+        (4, 1),
+        (5, 1),
+    ]
+
+
+def test_importer_cli(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'importer.db'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(Dataset(name="dataset"))
+        session.commit()
+
+    path = tmp_path / "records.ndjson"
+    path.write_text("".join(json.dumps({"data": {"i": i}}) + "\n" for i in range(3)))
+    result = subprocess.run(
+        [sys.executable, "importer.py", "1", str(path), "--chunk-size", "2"],
+        cwd=os.path.dirname(main.__file__),
+        env={**os.environ, "DATABASE_URI": str(engine.url)},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "imported 3 records from 3 rows" in result.stdout
+    with Session(engine) as session:
+        assert len(session.exec(select(Record)).all()) == 3
+
+
+def test_claim_ingest_job(session: Session):
+    dataset = Dataset(name="dataset")
+    session.add(dataset)
+    session.commit()
+    job = IngestJob(dataset_id=dataset.id, path="records.ndjson")
+    session.add(job)
+    session.commit()
+
+    # a job runs in the first worker that claims it
+    assert claim_ingest_job(session, job.id)
+    assert not claim_ingest_job(session, job.id)
+
+    # a running job without a recent heartbeat is resumed by another worker
+    later = datetime.utcnow() + timedelta(seconds=INGEST_HEARTBEAT_TIMEOUT + 1)
+    assert claim_ingest_job(session, job.id, now=later)
+    assert not claim_ingest_job(session, job.id, now=later)
+
+
+def test_resume_ingest_jobs(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'ingest.db'}",
+        connect_args={"check_same_thread": False},
+        poolclass=NullPool,
+    )
+    SQLModel.metadata.create_all(engine)
+    path = tmp_path / "records.ndjson"
+    path.write_text(json.dumps({"data": {"i": 1}}))
+    heartbeat_at = datetime.utcnow() - timedelta(seconds=INGEST_HEARTBEAT_TIMEOUT + 1)
+    with Session(engine) as session:
+        session.add(Dataset(name="dataset"))
+        session.add(
+            IngestJob(
+                dataset_id=1,
+                path=str(path),
+                status=IngestStatus.running,
+                heartbeat_at=heartbeat_at,
+            )
+        )
+        session.commit()
+
+    # a running job is only resumed once its worker stopped sending heartbeats
+    assert main.resume_ingest_jobs(engine, now=heartbeat_at) == []
+    assert main.resume_ingest_jobs(engine) == [1]
+    with Session(engine) as session:
+        for _ in range(100):
+            job = session.get(IngestJob, 1)
+            if job.status == IngestStatus.completed:
+                break
+            time.sleep(0.05)
+            session.expire_all()
+        assert job.status == IngestStatus.completed and job.num_records == 1
+
+
+def test_create_task_sequential(client: TestClient):
+    setup_labelqueue(client)
+
+    record_ids = []
+    for _ in range(len(db_records)):
+        response = claim_task(client)
+        assert response.status_code == 200
+        record_ids.append(TaskReadWithRelations(**response.json()).record.id)
+
+    assert record_ids == [1, 2, 3, 4]
+
+    # the step is completed once all of its records are assigned
+    response = claim_task(client)
+    assert response.status_code == 406
+    assert "does not have an active queue step" in response.json()["detail"]
+
+
+def test_create_task_is_idempotent(client: TestClient):
+    setup_labelqueue(client)
+
+    # a retried request returns the outstanding task instead of allocating a new record
+    task = client.post("/labelqueues/1/1/task/").json()
+    assert client.post("/labelqueues/1/1/task/").json()["id"] == task["id"]
+    assert client.get("/queuesteps/1").json()["num_records_assigned"] == 1
+
+    # with an idempotency key the original task is returned even after it is completed
+    headers = {"Idempotency-Key": "request-1"}
+    client.patch(f"/tasks/{task['id']}", json={"completed_data": {}})
+    task = client.post("/labelqueues/1/1/task/", headers=headers).json()
+    assert task["record"]["id"] == 2
+    client.patch(f"/tasks/{task['id']}", json={"completed_data": {}})
+    response = client.post("/labelqueues/1/1/task/", headers=headers)
+    assert response.json()["id"] == task["id"]
+    assert client.get("/queuesteps/1").json()["num_records_assigned"] == 2
+
+    # a new idempotency key does not allocate a record while a task is outstanding
+    task = client.post("/labelqueues/1/1/task/").json()
+    headers = {"Idempotency-Key": "request-2"}
+    response = client.post("/labelqueues/1/1/task/", headers=headers)
+    assert response.json()["id"] == task["id"]
+    assert client.get("/queuesteps/1").json()["num_records_assigned"] == 3
+
+
+def test_create_task_renews_lease(client: TestClient, session: Session):
+    setup_labelqueue(client)
+    client.patch("/labelqueues/1", json={"lease_duration": 60})
+    task = client.post("/labelqueues/1/1/task/").json()
+
+    # a task whose lease ran out but was not swept yet gets a fresh lease when handed back
+    session.execute(
+        update(Task.__table__)
+        .where(Task.id == task["id"])
+        .values(lease_expires_at=datetime.utcnow() - timedelta(seconds=1))
+    )
+    session.commit()
+    response = client.post("/labelqueues/1/1/task/")
+    assert response.json()["id"] == task["id"]
+    assert release_expired_tasks(session) == 0
+    assert (
+        client.patch(f"/tasks/{task['id']}", json={"completed_data": {}}).status_code
+        == 200
+    )
+
+
+def test_create_task_random(client: TestClient):
+    setup_labelqueue(
+        client, queuestep={**queuestep_json, "policy_args": {"random": True}}
+    )
+
+    record_ids = set()
+    for _ in range(len(db_records)):
+        response = claim_task(client)
+        assert response.status_code == 200
+        record_ids.add(TaskReadWithRelations(**response.json()).record.id)
+
+    assert record_ids == {1, 2, 3, 4}
+
+
+def test_frontier_tracks_new_records_and_released_tasks(client: TestClient):
+    setup_labelqueue(client, queuestep={**queuestep_json, "num_records": 5})
+
+    for _ in range(len(db_records)):
+        claim_task(client)
+
+    # records appended after registration are seeded into the frontier
+    client.post("/dataset/1/records", json=db_records[:1])
+    response = client.post("/labelqueues/1/1/task/")
+    assert response.status_code == 200
+    task = TaskReadWithRelations(**response.json())
+    assert task.record.id == 5
+
+    # a released task's record is assigned again
+    response = client.delete(f"/tasks/{task.id}")
+    assert response.status_code == 200
+    response = client.post("/labelqueues/1/1/task/")
+    assert response.status_code == 200
+    assert TaskReadWithRelations(**response.json()).record.id == 5
+
+
+def test_random_order_is_reproducible_from_seed(client: TestClient):
+    setup_labelqueue(
+        client,
+        queuestep={**queuestep_json, "policy_args": {"random": True, "seed": 1234}},
+    )
+
+    response = client.get("/queuesteps/1/frontier")
+    assert response.status_code == 200
+    frontier = response.json()
+    assert frontier == sorted(
+        range(1, len(db_records) + 1), key=lambda x: permutation_position(1234, x)
+    )
+
+    record_ids = [
+        TaskReadWithRelations(**claim_task(client).json()).record.id
+        for _ in range(len(db_records))
+    ]
+    assert record_ids == frontier
+
+
+@pytest.mark.parametrize("num_records", [300, 150])
+def test_concurrent_claims_are_unique(tmp_path, num_records):
+    num_claimers = 200
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'claims.db'}",
+        connect_args={"check_same_thread": False, "timeout": 60},
+        poolclass=NullPool,
+    )
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        dataset = Dataset(**db_json)
+        dataset.records = [Record(data={"i": i}) for i in range(num_records)]
+        labelqueue = LabelQueue(**labelqueue_json, dataset=dataset)
+        session.add(labelqueue)
+        session.flush()
+        queuestep = QueueStep(
+            **{**queuestep_json, "num_records": num_records},
+            labelqueue_id=labelqueue.id,
+            rank=1,
+            policy_args={},
+        )
+        session.add(queuestep)
+        session.flush()
+        queuestep.seed_frontier()
+        session.commit()
+        labelqueue_id = labelqueue.id
+
+    barrier = threading.Barrier(num_claimers)
+
+    def claim(user_id):
+        with Session(engine) as session:
+            labelqueue = session.get(LabelQueue, labelqueue_id)
+            labelqueue.queuesteps
+            barrier.wait()
+            task = labelqueue.create_task(user_id)
+            session.commit()
+            return task is not None
+
+    with ThreadPoolExecutor(max_workers=num_claimers) as pool:
+        claimed = list(pool.map(claim, range(num_claimers)))
+
+    assert sum(claimed) == min(num_claimers, num_records)
+    with Session(engine) as session:
+        record_ids = session.exec(select(Task.record_id)).all()
+    assert len(record_ids) == len(set(record_ids)) == sum(claimed)
+
+
+def test_create_task_reserves_next_records(client: TestClient, session: Session):
+    setup_labelqueue(client)
+
+    task = client.post("/labelqueues/1/1/task/", params={"reserve": 2}).json()
+    assert task["record"]["id"] == 1
+    reservations = task["reservations"]
+    assert [it["record"]["data"] for it in reservations] == [
+        record["data"] for record in db_records[1:3]
+    ]
+    assert all(it["reserved"] and it["lease_expires_at"] for it in reservations)
+
+    # the next request hands out the first reservation as a regular task
+    client.patch(f"/tasks/{task['id']}", json={"completed_data": {}})
+    task = client.post("/labelqueues/1/1/task/").json()
+    assert task["id"] == reservations[0]["id"]
+    assert not task["reserved"] and task["lease_expires_at"] is None
+
+    # a request with a new idempotency key also gets the next reservation
+    client.patch(f"/tasks/{task['id']}", json={"completed_data": {}})
+    headers = {"Idempotency-Key": "request-1"}
+    task = client.post("/labelqueues/1/1/task/", headers=headers).json()
+    assert task["id"] == reservations[1]["id"]
+    assert client.post("/labelqueues/1/1/task/", headers=headers).json() == task
+
+    # unused reservations are released with the expired leases
+    task = client.post("/labelqueues/1/1/task/", params={"reserve": 1}).json()
+    released = release_expired_tasks(
+        session, now=datetime.utcnow() + timedelta(hours=1)
+    )
+    assert released == 1
+    client.patch(f"/tasks/{task['id']}", json={"completed_data": {}})
+    task = client.post("/labelqueues/1/1/task/").json()
+    assert task["record"]["id"] == 4 and not task["reserved"]
+
+
+def test_wait_for_task_wakes_on_new_records(tmp_path):
+    # requests run concurrently here, so every request gets its own session
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'wait.db'}",
+        connect_args={"check_same_thread": False},
+        poolclass=NullPool,
+    )
+    SQLModel.metadata.create_all(engine)
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_session_override
+    try:
+        client = TestClient(app)
+        setup_labelqueue(client, queuestep={**queuestep_json, "num_records": 5})
+        for _ in range(len(db_records)):
+            claim_task(client)
+
+        # the request gives up once the timeout runs out
+        response = client.post("/labelqueues/1/1/task/wait", params={"timeout": 0.1})
+        assert response.status_code == 406
+
+        # a waiting request is woken as soon as records are added
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            start = time.monotonic()
+            waiting = pool.submit(
+                client.post, "/labelqueues/1/1/task/wait", params={"timeout": 30}
+            )
+            time.sleep(0.5)
+            client.post("/dataset/1/records", json=db_records[:1])
+            response = waiting.result()
+
+        assert time.monotonic() - start < 10
+        assert response.status_code == 200
+        assert response.json()["record"]["id"] == 5
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_task_channel(client: TestClient, session: Session):
+    setup_labelqueue(client)
+
+    with client.websocket_connect("/labelqueues/1/1/ws") as websocket:
+        task = websocket.receive_json()
+        assert task["record"]["id"] == 1
+
+        websocket.send_json({"id": task["id"] + 1, "completed_data": {}})
+        assert "current task" in websocket.receive_json()["detail"]
+
+        # completing the current task pushes the prefetched one
+        record_ids = []
+        for _ in range(len(db_records)):
+            websocket.send_json({"id": task["id"], "completed_data": {"label": "a"}})
+            task = websocket.receive_json()
+            record_ids.append(task.get("record", {}).get("id"))
+        assert record_ids == [2, 3, 4, None]
+        assert "does not have an active queue step" in task["detail"]
+
+    tasks = session.exec(select(Task)).all()
+    assert [task.completed for task in tasks] == [True] * len(db_records)
+
+
+def test_task_channel_releases_prefetched_task(client: TestClient, session: Session):
+    setup_labelqueue(client)
+
+    with client.websocket_connect("/labelqueues/1/1/ws") as websocket:
+        assert websocket.receive_json()["record"]["id"] == 1
+        websocket.send_text("not json")
+        assert "detail" in websocket.receive_json()
+
+    # the prefetched task is released when the channel closes; the current one is kept
+    session.expire_all()
+    assert [task.record_id for task in session.exec(select(Task)).all()] == [1]
+    with client.websocket_connect("/labelqueues/1/1/ws") as websocket:
+        assert websocket.receive_json()["record"]["id"] == 1
+
+
+def test_task_channel_renews_prefetched_lease(client: TestClient, session: Session):
+    setup_labelqueue(client)
+    client.patch("/labelqueues/1", json={"lease_duration": 60})
+
+    def expire_lease(task_id, seconds):
+        session.execute(
+            update(Task.__table__)
+            .where(Task.id == task_id)
+            .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=seconds))
+        )
+        session.commit()
+
+    with client.websocket_connect("/labelqueues/1/1/ws") as websocket:
+        task = websocket.receive_json()
+        assert task["record"]["id"] == 1
+
+        # the prefetched task gets a fresh lease when it becomes the current task
+        expire_lease(2, 1)
+        websocket.send_json({"id": task["id"], "completed_data": {}})
+        task = websocket.receive_json()
+        assert task["id"] == 2
+        session.expire_all()
+        assert session.get(Task, 2).lease_expires_at > datetime.utcnow() + timedelta(
+            seconds=30
+        )
+
+        # a prefetched task that was swept meanwhile is replaced
+        while session.get(Task, 3) is None:
+            time.sleep(0.01)
+            session.expire_all()
+        expire_lease(3, -1)
+        assert release_expired_tasks(session) == 1
+        websocket.send_json({"id": task["id"], "completed_data": {}})
+        task = websocket.receive_json()
+        assert task["record"]["id"] == 3
+        session.expire_all()
+        assert session.get(Task, task["id"]).lease_expires_at > datetime.utcnow()
+
+
+def test_create_user_task_routes_across_labelqueues(client: TestClient):
+    setup_labelqueue(client)
+    client.post("/labelqueues/", json=labelqueue_json)
+    client.post("/datasets/1/labelqueues/2")
+    client.post("/labelqueues/2/users/1")
+    client.post(
+        "/labelqueues/2/queue_step/", json={**queuestep_json, "num_records": 10}
+    )
+
+    # the labelqueue with the most unassigned capacity is used first; once its frontier is
+    # empty the next labelqueue takes over
+    labelqueue_ids = []
+    for _ in range(len(db_records) + 1):
+        task = client.post("/users/1/task/").json()
+        labelqueue_ids.append(task["labelqueue"]["id"])
+        if len(labelqueue_ids) <= len(db_records):
+            client.patch(f"/tasks/{task['id']}", json={"completed_data": {}})
+    assert labelqueue_ids == [2, 2, 2, 2, 1]
+
+    # the outstanding task is returned until it is completed
+    assert client.post("/users/1/task/").json()["id"] == task["id"]
+
+    client.post("/users/", json={**user_json, "email": "second.user@example.com"})
+    assert client.post("/users/2/task/").status_code == 406
+
+
+def test_create_tasks_batch(client: TestClient):
+    setup_labelqueue(client)
+
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 3})
+    assert response.status_code == 200
+    tasks = [TaskReadWithRelations(**task) for task in response.json()]
+    assert [task.record.id for task in tasks] == [1, 2, 3]
+
+    # the batch is truncated when the queue runs out of records
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 3})
+    assert response.status_code == 200
+    assert [task["record"]["id"] for task in response.json()] == [4]
+
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 3})
+    assert response.status_code == 406
+
+
+def test_create_task_consensus(client: TestClient):
+    setup_labelqueue(
+        client,
+        queuestep={
+            **queuestep_json,
+            "type": "consensus",
+            "policy_args": {"num_labelers": 2},
+        },
+    )
+    client.post("/users/", json={**user_json, "email": "second.user@example.com"})
+    client.post("/users/", json={**user_json, "email": "third.user@example.com"})
+    client.post("/labelqueues/1/users/2")
+    client.post("/labelqueues/1/users/3")
+
+    # the user never receives the same record twice
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in response.json()] == [1, 2, 3, 4]
+
+    # the least assigned records come first
+    response = claim_task(client, user_id=2)
+    assert response.json()["record"]["id"] == 1
+    response = client.post("/labelqueues/1/3/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in response.json()] == [2, 3, 4]
+
+    # every record has been assigned to two users
+    assert client.post("/labelqueues/1/2/task/").status_code == 406
+
+    # releasing a task makes its record available to another user again
+    task_id = response.json()[0]["id"]
+    assert client.delete(f"/tasks/{task_id}").status_code == 200
+    response = client.post("/labelqueues/1/2/task/")
+    assert response.json()["record"]["id"] == 2
+
+
+def test_create_task_consensus_starts_num_records(client: TestClient):
+    setup_labelqueue(
+        client,
+        queuestep={
+            **queuestep_json,
+            "num_records": 2,
+            "type": "consensus",
+            "policy_args": {"num_labelers": 2},
+        },
+    )
+    client.post("/users/", json={**user_json, "email": "second.user@example.com"})
+    client.post("/labelqueues/1/users/2")
+
+    # the dataset has more records than the queuestep, which only starts two of them
+    first_tasks = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in first_tasks.json()] == [1, 2]
+    second_tasks = client.post("/labelqueues/1/2/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in second_tasks.json()] == [1, 2]
+    assert client.get("/queuesteps/1").json()["completed"]
+
+    # a record whose tasks are all released frees its place for one other record
+    for tasks in [first_tasks, second_tasks]:
+        assert client.delete(f"/tasks/{tasks.json()[0]['id']}").status_code == 200
+    response = client.post("/labelqueues/1/2/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in response.json()] == [1]
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in response.json()] == [1]
+    assert client.get("/queuesteps/1").json()["num_records_started"] == 2
+
+
+def test_create_task_priority(client: TestClient):
+    setup_labelqueue(
+        client,
+        queuestep={
+            **queuestep_json,
+            "type": "priority",
+            "policy_args": {"field": "score"},
+        },
+    )
+    client.post(
+        "/dataset/1/records",
+        json=[{"data": {"score": 5}}, {"data": {"score": 10}}],
+    )
+
+    # records are served by descending priority from the data field
+    response = client.post("/labelqueues/1/1/task/")
+    assert response.json()["record"]["id"] == 6
+
+    # uploaded priorities reorder the remaining records
+    response = client.put(
+        "/queuesteps/1/priorities",
+        json=[
+            {"record_id": 2, "priority": 20},
+            {"record_id": 3, "priority": 7},
+            {"record_id": 6, "priority": 100},
+        ],
+    )
+    assert response.json() == {"ok": True, "num_updated": 2}
+
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 3})
+    assert [task["record"]["id"] for task in response.json()] == [2, 3, 5]
+
+
+def test_expired_leases_are_released(client: TestClient, session: Session):
+    setup_labelqueue(client)
+    client.patch("/labelqueues/1", json={"lease_duration": 60})
+
+    tasks = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 2}).json()
+    assert [task["record"]["id"] for task in tasks] == [1, 2]
+    assert tasks[0]["lease_expires_at"] is not None
+
+    # a heartbeat keeps the first task; the second task's lease runs out
+    lease_expires_at = datetime.fromisoformat(tasks[1]["lease_expires_at"])
+    session.get(Task, 1).lease_expires_at = lease_expires_at + timedelta(hours=1)
+    session.commit()
+
+    assert (
+        release_expired_tasks(session, now=lease_expires_at + timedelta(seconds=1)) == 1
+    )
+    assert session.get(Task, 2) is None
+
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 1})
+    assert [task["record"]["id"] for task in response.json()] == [2]
+
+    response = client.post("/tasks/1/lease")
+    assert response.status_code == 200
+
+
+def test_queuestep_capacity(client: TestClient):
+    setup_labelqueue(client, queuestep={**queuestep_json, "num_records": 2})
+    client.post("/labelqueues/1/queue_step/", json={**queuestep_json, "num_records": 1})
+
+    # the first step completes once its capacity is assigned and the second step takes over
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert [task["queuestep"]["id"] for task in response.json()] == [1, 1]
+    queuestep = client.get("/queuesteps/1").json()
+    assert queuestep["completed"] and queuestep["num_records_assigned"] == 2
+
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert [task["queuestep"]["id"] for task in response.json()] == [2]
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert response.status_code == 406
+
+    # completion is counted once per task
+    response = client.patch("/tasks/1", json={"completed_data": {"label": "flowers"}})
+    assert response.status_code == 200
+    assert response.json()["completed"]
+    assert client.patch("/tasks/1", json={"completed_data": {}}).status_code == 406
+    assert client.get("/queuesteps/1").json()["num_records_completed"] == 1
+
+    # releasing a task reopens its step
+    client.delete("/tasks/2")
+    assert not client.get("/queuesteps/1").json()["completed"]
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 1})
+    assert [task["record"]["id"] for task in response.json()] == [2]
+
+
+def test_update_queuestep_policy(client: TestClient):
+    setup_labelqueue(client)
+
+    # arguments of the previous policy are dropped with a change of type
+    response = client.patch("/queuesteps/1", json={"type": "consensus"})
+    assert response.status_code == 200
+    assert response.json()["policy_args"]["num_labelers"] == 2
+    assert client.get("/queuesteps/1").json()["num_records_started"] == 0
+
+    response = client.patch("/queuesteps/1", json={"policy_args": {"num_labelers": 3}})
+    assert response.json()["policy_args"]["num_labelers"] == 3
+
+    # arguments that do not fit the policy are rejected
+    response = client.patch("/queuesteps/1", json={"policy_args": {"random": True}})
+    assert response.status_code == 422
+    response = client.patch(
+        "/queuesteps/1", json={"type": "priority", "policy_args": {"num_labelers": 2}}
+    )
+    assert response.status_code == 422
+    assert client.get("/queuesteps/1").json()["type"] == "consensus"
+
+
+def test_update_queuestep_rebuilds_frontier(client: TestClient):
+    setup_labelqueue(client)
+    client.post(
+        "/dataset/1/records/", json=[{"data": {"score": 1}}, {"data": {"score": 3}}]
+    )
+    claim_task(client)
+
+    # the remaining records are reordered by the new policy
+    client.patch(
+        "/queuesteps/1", json={"type": "priority", "policy_args": {"field": "score"}}
+    )
+    assert client.get("/queuesteps/1/frontier").json() == [6, 5, 2, 3, 4]
+
+    response = client.patch(
+        "/queuesteps/1", json={"type": "distribute", "policy_args": {"random": True}}
+    )
+    assert response.json()["policy_args"]["seed"] is not None
+    frontier = client.get("/queuesteps/1/frontier").json()
+    assert sorted(frontier) == [2, 3, 4, 5, 6]
+    response = client.post("/labelqueues/1/1/task/")
+    assert response.json()["record"]["id"] == frontier[0]
+
+
+def test_queuestep_user_quota(client: TestClient):
+    setup_labelqueue(
+        client, queuestep={**queuestep_json, "policy_args": {"max_tasks_per_user": 2}}
+    )
+    client.post("/users/", json={**user_json, "email": "second.user@example.com"})
+    client.post("/labelqueues/1/users/2")
+
+    # the first user is capped at two tasks and the rest is left for the second user
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in response.json()] == [1, 2]
+    assert client.post("/labelqueues/1/1/tasks/").status_code == 406
+    response = client.post("/labelqueues/1/2/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in response.json()] == [3, 4]
+
+    client.patch("/tasks/1", json={"completed_data": {}})
+    client.delete("/tasks/2")
+    stats = client.get("/queuesteps/1/users").json()
+    assert [
+        (it["user_id"], it["num_assigned"], it["num_completed"]) for it in stats
+    ] == [(1, 1, 1), (2, 2, 0)]
+
+    # a released task frees up the user's quota again
+    response = client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 10})
+    assert [task["record"]["id"] for task in response.json()] == [2]
+
+
+def test_queuestep_ranks_are_per_labelqueue(client: TestClient):
+    setup_labelqueue(client)
+    client.post("/labelqueues/", json=labelqueue_json)
+    client.post("/datasets/1/labelqueues/2")
+    client.post("/labelqueues/2/users/1")
+
+    response = client.post("/labelqueues/2/queue_step/", json=queuestep_json)
+    assert response.status_code == 200
+    assert response.json()["rank"] == 1
+
+    response = client.post("/labelqueues/2/1/task/")
+    assert response.json()["queuestep"]["id"] == 2
+
+
+def test_complete_tasks_bulk(client: TestClient):
+    setup_labelqueue(client)
+    client.post("/labelqueues/1/1/tasks/", params={"num_tasks": 3})
+    client.patch("/tasks/2", json={"completed_data": {"label": "posies"}})
+
+    response = client.post(
+        "/tasks/complete/",
+        json=[
+            {"id": 1, "completed_data": {"label": "flowers"}},
+            {"id": 2, "completed_data": {"label": "again"}},
+            {"id": 3, "completed_data": {"label": "bird"}},
+            {"id": 10, "completed_data": {}},
+        ],
+    )
+    assert response.status_code == 200
+    assert [(it["id"], it["ok"]) for it in response.json()] == [
+        (1, True),
+        (2, False),
+        (3, True),
+        (10, False),
+    ]
+
+    assert client.get("/queuesteps/1").json()["num_records_completed"] == 3
+    labelqueue = client.get("/labelqueues/1").json()
+    assert [task["completed_data"]["label"] for task in labelqueue["tasks"]] == [
+        "flowers",
+        "posies",
+        "bird",
+    ]
+
+
+# the schema of databases created before the tables were extended
+baseline_schema = """
+CREATE TABLE dataset (
+	name VARCHAR NOT NULL,
+	description VARCHAR,
+	id INTEGER NOT NULL,
+	PRIMARY KEY (id)
+);
+CREATE INDEX ix_dataset_id ON dataset (id);
+CREATE TABLE user (
+	email VARCHAR,
+	role VARCHAR(7),
+	name VARCHAR NOT NULL,
+	id INTEGER NOT NULL,
+	PRIMARY KEY (id),
+	UNIQUE (email)
+);
+CREATE TABLE record (
+	data JSON,
+	id INTEGER NOT NULL,
+	dataset_id INTEGER,
+	PRIMARY KEY (id),
+	FOREIGN KEY(dataset_id) REFERENCES dataset (id)
+);
+CREATE INDEX ix_record_dataset_id ON record (dataset_id);
+CREATE INDEX ix_record_id ON record (id);
+CREATE TABLE labelqueue (
+	name VARCHAR NOT NULL,
+	description VARCHAR,
+	id INTEGER NOT NULL,
+	dataset_id INTEGER,
+	PRIMARY KEY (id),
+	FOREIGN KEY(dataset_id) REFERENCES dataset (id)
+);
+CREATE INDEX ix_labelqueue_dataset_id ON labelqueue (dataset_id);
+CREATE TABLE labelqueueuserlink (
+	labelqueue_id INTEGER NOT NULL,
+	user_id INTEGER NOT NULL,
+	PRIMARY KEY (labelqueue_id, user_id),
+	FOREIGN KEY(labelqueue_id) REFERENCES labelqueue (id),
+	FOREIGN KEY(user_id) REFERENCES user (id)
+);
+CREATE TABLE queuestep (
+	type VARCHAR(10),
+	policy_args JSON,
+	rank INTEGER,
+	name VARCHAR NOT NULL,
+	description VARCHAR,
+	num_records INTEGER NOT NULL,
+	id INTEGER NOT NULL,
+	labelqueue_id INTEGER,
+	num_records_completed INTEGER NOT NULL,
+	completed BOOLEAN NOT NULL,
+	PRIMARY KEY (id),
+	UNIQUE (rank),
+	FOREIGN KEY(labelqueue_id) REFERENCES labelqueue (id)
+);
+CREATE INDEX ix_queuestep_labelqueue_id ON queuestep (labelqueue_id);
+CREATE TABLE task (
+	created_at DATETIME NOT NULL,
+	completed_data JSON,
+	id INTEGER NOT NULL,
+	record_id INTEGER,
+	dataset_id INTEGER,
+	user_id INTEGER,
+	queuestep_id INTEGER,
+	labelqueue_id INTEGER,
+	completed BOOLEAN NOT NULL,
+	PRIMARY KEY (id),
+	FOREIGN KEY(record_id) REFERENCES record (id),
+	FOREIGN KEY(dataset_id) REFERENCES dataset (id),
+	FOREIGN KEY(user_id) REFERENCES user (id),
+	FOREIGN KEY(queuestep_id) REFERENCES queuestep (id),
+	FOREIGN KEY(labelqueue_id) REFERENCES labelqueue (id)
+);
+CREATE INDEX ix_task_id ON task (id);
+CREATE INDEX ix_task_completed ON task (completed);
+CREATE INDEX ix_task_labelqueue_id ON task (labelqueue_id);
+CREATE INDEX ix_task_user_id ON task (user_id);
+"""
+
+
+def test_startup_upgrades_baseline_database(tmp_path, monkeypatch):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'baseline.db'}",
+        connect_args={"check_same_thread": False},
+        poolclass=NullPool,
+    )
+    connection = engine.raw_connection()
+    connection.executescript(baseline_schema)
+    connection.executescript("""
+        INSERT INTO dataset (id, name) VALUES (1, 'dataset');
+        INSERT INTO record (id, dataset_id, data)
+            VALUES (1, 1, '{"text": "a"}'), (2, 1, '{"text": "b"}');
+        INSERT INTO labelqueue (id, name, dataset_id) VALUES (1, 'labelqueue', 1);
+        INSERT INTO user (id, name, email, role) VALUES (1, 'user', 'a@b.com', 'labeler');
+        INSERT INTO labelqueueuserlink VALUES (1, 1);
+        INSERT INTO queuestep (id, labelqueue_id, name, type, policy_args, num_records,
+            rank, num_records_completed, completed)
+            VALUES (1, 1, 'step', 'distribute', '{"random": false}', 2, 1, 1, 0);
+        INSERT INTO task (id, created_at, completed_data, record_id, dataset_id, user_id,
+            queuestep_id, labelqueue_id, completed)
+            VALUES (1, '2023-01-01 00:00:00', '{"label": 1}', 1, 1, 1, 1, 1, 1);
+        """)
+    connection.close()
+
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(main, "engine", engine)
+    main.on_startup()
+    # upgrading an up to date database is a no-op
+    main.on_startup()
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_session_override
+    try:
+        client = TestClient(app)
+        queuestep = client.get("/queuesteps/1").json()
+        assert queuestep["num_records_assigned"] == 1
+        assert client.get("/queuesteps/1/users").json()[0]["num_completed"] == 1
+        assert client.get("/records/1").json()["data"] == {"text": "a"}
+
+        response = claim_task(client)
+        assert response.json()["record"]["id"] == 2
+        assert client.get("/queuesteps/1").json()["completed"]
+
+        # queuestep ranks are unique per labelqueue rather than globally
+        client.post("/labelqueues/", json=labelqueue_json)
+        response = client.post("/labelqueues/2/queue_step/", json=queuestep_json)
+        assert response.json()["rank"] == 1
+    finally:
+        app.dependency_overrides.clear()
@@ -0,0 +1,68 @@
+from typing import Dict, Set
+import asyncio
+import threading
+
+
+class TaskWaiters:
+    """
+    Wake long-polling task requests when a labelqueue may have work again.
+
+    A waiting request registers a future for its labelqueue before it tries to claim a task, so
+    a notification that arrives between a failed claim and the wait is not lost. Endpoints run
+    in the threadpool, so notifications resolve the futures on their event loop with
+    call_soon_threadsafe. Waiters are per process; requests waiting in another worker are only
+    woken by their timeout.
+    """
+
+    def __init__(self):
+        self._waiters: Dict[int, Set[asyncio.Future]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, labelqueue_id: int) -> asyncio.Future:
+        """
+        Register a future that is resolved on the next notification for the labelqueue.
+        Must be called from the event loop.
+        """
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._waiters.setdefault(labelqueue_id, set()).add(future)
+        return future
+
+    def discard(self, labelqueue_id: int, future: asyncio.Future):
+        with self._lock:
+            futures = self._waiters.get(labelqueue_id)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self._waiters[labelqueue_id]
+
+    async def wait(self, future: asyncio.Future, timeout: float) -> bool:
+        """
+        Wait until the future is resolved or the timeout runs out.
+        Returns whether the future was resolved.
+        """
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def notify(self, labelqueue_id: int):
+        """
+        Wake every request waiting on the labelqueue. Safe to call from any thread.
+        """
+        with self._lock:
+            futures = self._waiters.pop(labelqueue_id, ())
+        for future in futures:
+            future.get_loop().call_soon_threadsafe(_resolve, future)
+
+    def notify_all(self):
+        with self._lock:
+            labelqueue_ids = list(self._waiters)
+        for labelqueue_id in labelqueue_ids:
+            self.notify(labelqueue_id)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)